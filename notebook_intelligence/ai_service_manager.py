@@ -1,8 +1,10 @@
 # Copyright (c) Mehmet Bektas <mbektasgh@outlook.com>
 
+import asyncio
 import json
 from os import path
 import os
+import re
 import sys
 from typing import Dict
 import logging
@@ -21,12 +23,14 @@ from notebook_intelligence.util import ThreadSafeWebSocketConnector
 log = logging.getLogger(__name__)
 
 DEFAULT_CHAT_PARTICIPANT_ID = 'default'
-RESERVED_LLM_PROVIDER_IDS = set([
+# optional @participant and /command prefixes followed by the input
+PROMPT_REGEX = re.compile(r'\s*(?:@(\S*)(?:\s+|$))?(?:/(\S*)(?:\s+|$))?(.*)', re.DOTALL)
+RESERVED_LLM_PROVIDER_IDS = frozenset({
     'openai', 'anthropic', 'chat', 'copilot', 'jupyter', 'jupyterlab', 'jlab', 'notebook', 'intelligence', 'nb', 'nbi', 'ai', 'config', 'settings', 'ui', 'cell', 'code', 'file', 'data', 'new'
-])
-RESERVED_PARTICIPANT_IDS = set([
+})
+RESERVED_PARTICIPANT_IDS = frozenset({
     'chat', 'copilot', 'jupyter', 'jupyterlab', 'jlab', 'notebook', 'intelligence', 'nb', 'nbi', 'terminal', 'vscode', 'workspace', 'help', 'ai', 'config', 'settings', 'ui', 'cell', 'code', 'file', 'data', 'new', 'run', 'search'
-])
+})
 
 class AIServiceManager(Host):
     def __init__(self, options: dict = {}):
@@ -40,7 +44,13 @@ class AIServiceManager(Host):
         self._openai_compatible_llm_provider = OpenAICompatibleLLMProvider()
         self._litellm_compatible_llm_provider = LiteLLMCompatibleLLMProvider()
         self._ollama_llm_provider = OllamaLLMProvider()
+        # models of the background refresh are picked up by the next capabilities poll
+        self._ollama_llm_provider.chat_models_updated_signal.connect(self.invalidate_model_id_cache)
         self._extensions = []
+        # model type -> model list returned by the *_model_ids properties
+        self._model_id_cache: Dict[str, list[dict]] = {}
+        # chat participant list returned by chat_participant_capabilities
+        self._chat_participant_capabilities: list[dict] = None
         self._websocket_connector: ThreadSafeWebSocketConnector = None
         self.initialize()
 
@@ -63,6 +73,9 @@ class AIServiceManager(Host):
 
     def initialize(self):
         self.chat_participants = {}
+        # ids of participants registered by NBI extensions
+        self._extension_chat_participant_ids: set[str] = set()
+        self.invalidate_chat_participant_capabilities()
         self.register_llm_provider(GitHubCopilotLLMProvider())
         self.register_llm_provider(self._openai_compatible_llm_provider)
         self.register_llm_provider(self._litellm_compatible_llm_provider)
@@ -105,6 +118,8 @@ class AIServiceManager(Host):
 
         is_github_copilot_chat_model = isinstance(chat_model_provider, GitHubCopilotLLMProvider)
         default_chat_participant = GithubCopilotChatParticipant() if is_github_copilot_chat_model else BaseChatParticipant()
+        if type(default_chat_participant) is not type(self.chat_participants.get(DEFAULT_CHAT_PARTICIPANT_ID)):
+            self.invalidate_chat_participant_capabilities()
         self._default_chat_participant = default_chat_participant
 
         self.chat_participants[DEFAULT_CHAT_PARTICIPANT_ID] = self._default_chat_participant
@@ -127,7 +142,9 @@ class AIServiceManager(Host):
                         class_name = data['class']
                         extension = self.load_extension(class_name)
                         if extension:
+                            participant_ids = set(self.chat_participants.keys())
                             extension.activate(self)
+                            self._extension_chat_participant_ids |= self.chat_participants.keys() - participant_ids
                             log.info(f"Activated NBI extension '{class_name}'.")
                             self._extensions.append(extension)
             except Exception as e:
@@ -149,22 +166,27 @@ class AIServiceManager(Host):
         return None
 
     def register_chat_participant(self, participant: ChatParticipant):
-        if participant.id in RESERVED_PARTICIPANT_IDS:
-            log.error(f"Participant ID '{participant.id}' is reserved!")
+        # interned so that lookups with ids parsed from prompts compare by identity first
+        participant_id = sys.intern(participant.id)
+        if participant_id in RESERVED_PARTICIPANT_IDS:
+            log.error(f"Participant ID '{participant_id}' is reserved!")
             return
-        if participant.id in self.chat_participants:
-            log.error(f"Participant ID '{participant.id}' is already in use!")
+        if participant_id in self.chat_participants:
+            log.error(f"Participant ID '{participant_id}' is already in use!")
             return
-        self.chat_participants[participant.id] = participant
+        self.chat_participants[participant_id] = participant
+        self.invalidate_chat_participant_capabilities()
 
     def register_llm_provider(self, provider: LLMProvider) -> None:
-        if provider.id in RESERVED_LLM_PROVIDER_IDS:
-            log.error(f"LLM Provider ID '{provider.id}' is reserved!")
+        provider_id = sys.intern(provider.id)
+        if provider_id in RESERVED_LLM_PROVIDER_IDS:
+            log.error(f"LLM Provider ID '{provider_id}' is reserved!")
             return
-        if provider.id in self.chat_participants:
-            log.error(f"LLM Provider ID '{provider.id}' is already in use!")
+        if provider_id in self.llm_providers:
+            log.error(f"LLM Provider ID '{provider_id}' is already in use!")
             return
-        self.llm_providers[provider.id] = provider
+        self.llm_providers[provider_id] = provider
+        self.invalidate_model_id_cache()
 
     def register_completion_context_provider(self, provider: CompletionContextProvider) -> None:
         if provider.id in self.completion_context_providers:
@@ -207,26 +229,10 @@ class AIServiceManager(Host):
 
     @staticmethod
     def parse_prompt(prompt: str) -> tuple[str, str, str]:
-        participant = DEFAULT_CHAT_PARTICIPANT_ID
-        command = ''
-        input = ''
-
-        prompt = prompt.lstrip()
-        parts = prompt.split(' ')
-        parts = [part for part in parts if part.strip() != '']
-
-        if len(parts) > 0:
-            if parts[0].startswith('@'):
-                participant = parts[0][1:]
-                parts = parts[1:]
-
-        if len(parts) > 0:
-            if parts[0].startswith('/'):
-                command = parts[0][1:]
-                parts = parts[1:]
-
-        if len(parts) > 0:
-            input = " ".join(parts)
+        match = PROMPT_REGEX.match(prompt)
+        participant = sys.intern(match.group(1)) if match.group(1) is not None else DEFAULT_CHAT_PARTICIPANT_ID
+        command = match.group(2) or ''
+        input = match.group(3).rstrip()
 
         return [participant, command, input]
     
@@ -273,25 +279,59 @@ class AIServiceManager(Host):
     
     @property
     def chat_model_ids(self) -> list[ChatModel]:
-        model_ids = []
-        for provider in self.llm_providers.values():
-            model_ids += [{"provider": provider.id, "id": model.id, "name": model.name, "context_window": model.context_window, "properties": [property.to_dict() for property in model.properties]} for model in provider.chat_models]
+        model_id_cache = self._model_id_cache
+        model_ids = model_id_cache.get('chat')
+        if model_ids is None:
+            model_ids = []
+            for provider in self.llm_providers.values():
+                model_ids += [{"provider": provider.id, "id": model.id, "name": model.name, "context_window": model.context_window, "properties": [property.to_dict() for property in model.properties]} for model in provider.chat_models]
+            model_id_cache['chat'] = model_ids
         return model_ids
 
     @property
     def inline_completion_model_ids(self) -> list[InlineCompletionModel]:
-        model_ids = []
-        for provider in self.llm_providers.values():
-            model_ids += [{"provider": provider.id, "id": model.id, "name": model.name, "context_window": model.context_window, "properties": [property.to_dict() for property in model.properties]} for model in provider.inline_completion_models]
+        model_id_cache = self._model_id_cache
+        model_ids = model_id_cache.get('inline-completion')
+        if model_ids is None:
+            model_ids = []
+            for provider in self.llm_providers.values():
+                model_ids += [{"provider": provider.id, "id": model.id, "name": model.name, "context_window": model.context_window, "properties": [property.to_dict() for property in model.properties]} for model in provider.inline_completion_models]
+            model_id_cache['inline-completion'] = model_ids
         return model_ids
     
     @property
     def embedding_model_ids(self) -> list[EmbeddingModel]:
-        model_ids = []
-        for provider in self.llm_providers.values():
-            model_ids += [{"id": f"{provider.id}::{model.id}", "name": f"{provider.name} / {model.name}", "context_window": model.context_window} for model in provider.embedding_models]
+        model_id_cache = self._model_id_cache
+        model_ids = model_id_cache.get('embedding')
+        if model_ids is None:
+            model_ids = []
+            for provider in self.llm_providers.values():
+                model_ids += [{"id": f"{provider.id}::{model.id}", "name": f"{provider.name} / {model.name}", "context_window": model.context_window} for model in provider.embedding_models]
+            model_id_cache['embedding'] = model_ids
         return model_ids
 
+    # call when the model list or model properties of a provider change,
+    # can be called from other threads. A list being built from the old
+    # models is stored in the replaced dict and dropped
+    def invalidate_model_id_cache(self):
+        self._model_id_cache = {}
+
+    @property
+    def chat_participant_capabilities(self) -> list[dict]:
+        if self._chat_participant_capabilities is None:
+            self._chat_participant_capabilities = [{
+                "id": participant.id,
+                "name": participant.name,
+                "description": participant.description,
+                "iconPath": participant.icon_path,
+                "commands": [command.name for command in participant.commands]
+            } for participant in self.chat_participants.values()]
+        return self._chat_participant_capabilities
+
+    # call when chat participants are added or replaced
+    def invalidate_chat_participant_capabilities(self):
+        self._chat_participant_capabilities = None
+
     def get_chat_participant(self, prompt: str) -> ChatParticipant:
         (participant_id, command, input) = AIServiceManager.parse_prompt(prompt)
         return self.chat_participants.get(participant_id, DEFAULT_CHAT_PARTICIPANT_ID)
@@ -308,6 +348,9 @@ class AIServiceManager(Host):
         request.command = command
         request.prompt = prompt
         response.participant_id  = participant_id
+        if participant_id in self._extension_chat_participant_ids:
+            # extension participants may block, run them in a worker thread with their own event loop
+            return await asyncio.to_thread(asyncio.run, participant.handle_chat_request(request, response, options))
         return await participant.handle_chat_request(request, response, options)
 
     async def get_completion_context(self, request: ContextRequest) -> CompletionContext:
@@ -319,18 +362,29 @@ class AIServiceManager(Host):
         if cancel_token.is_cancel_requested:
             return context
 
-        for provider in self.completion_context_providers:
-            if cancel_token.is_cancel_requested:
-                return context
-            provider = self.completion_context_providers.get(provider)
-            if provider.id not in allowed_context_providers and '*' not in allowed_context_providers:
-                continue
+        providers = [provider for provider in self.completion_context_providers.values() if provider.id in allowed_context_providers or '*' in allowed_context_providers]
+
+        async def _get_provider_context(index: int, provider: CompletionContextProvider) -> tuple[int, CompletionContext]:
             try:
-                provider_context = provider.handle_completion_context_request(request)
-                if provider_context.items:
-                    context.items += provider_context.items
+                return index, await provider.ahandle_completion_context_request(request)
             except Exception as e:
                 log.error(f"Error while getting completion context from provider '{provider.id}'!\n{e}")
+                return index, None
+
+        # query the providers concurrently, items are added in provider order
+        tasks = [asyncio.ensure_future(_get_provider_context(index, provider)) for index, provider in enumerate(providers)]
+        provider_contexts: list[CompletionContext] = [None] * len(tasks)
+        for next_completed in asyncio.as_completed(tasks):
+            index, provider_context = await next_completed
+            provider_contexts[index] = provider_context
+            if cancel_token.is_cancel_requested:
+                for task in tasks:
+                    task.cancel()
+                return context
+
+        for provider_context in provider_contexts:
+            if provider_context is not None and provider_context.items:
+                context.items += provider_context.items
 
         return context
     
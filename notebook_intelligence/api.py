@@ -4,6 +4,7 @@ import asyncio
 from typing import Any, Callable, Dict, Union
 from dataclasses import asdict, dataclass
 from enum import Enum
+import threading
 import uuid
 from fuzzy_json import loads as fuzzy_json_loads
 import logging
@@ -89,6 +90,26 @@ class CancelToken:
     def cancellation_signal(self) -> Signal:
         return self._cancellation_signal
 
+class CancelTokenImpl(CancelToken):
+    def __init__(self):
+        super().__init__()
+        self._cancellation_signal = SignalImpl()
+        # set from the IOLoop thread, checked from provider threads
+        self._cancellation_event = threading.Event()
+
+    @property
+    def is_cancel_requested(self) -> bool:
+        return self._cancellation_event.is_set()
+
+    def cancel_request(self) -> None:
+        self._cancellation_requested = True
+        self._cancellation_event.set()
+        self._cancellation_signal.emit()
+
+    def wait(self, timeout: float = None) -> bool:
+        # block until cancellation is requested or timeout, returns is_cancel_requested
+        return self._cancellation_event.wait(timeout)
+
 @dataclass
 class RequestToolSelection:
     built_in_toolsets: list[str] = None
@@ -230,10 +251,21 @@ class ChatResponse:
         raise NotImplemented
 
     def stream(self, data: ResponseStreamData, finish: bool = False) -> None:
+        # callers may reuse data after this returns, copy anything that is kept
         raise NotImplemented
+
+    def stream_batch(self, data: list[Union[ResponseStreamData, dict]]) -> None:
+        # responses that can send multiple items at once should override this
+        for item in data:
+            self.stream(item)
     
     def finish(self) -> None:
         raise NotImplemented
+
+    def complete(self, data: dict) -> None:
+        # single-shot responses, responses that can send data with the end of stream should override this
+        self.stream(data)
+        self.finish()
     
     @property
     def user_input_signal(self) -> Signal:
@@ -319,6 +351,8 @@ class Tool:
         return None
 
     async def handle_tool_call(self, request: ChatRequest, response: ChatResponse, tool_context: dict, tool_args: dict) -> str:
+        # built-in tools run on the server event loop and must not block,
+        # extension tools are called in a worker thread with their own event loop
         raise NotImplemented
 
 class Toolset:
@@ -473,6 +507,8 @@ class ChatParticipant:
         return set(["*"])
 
     async def handle_chat_request(self, request: ChatRequest, response: ChatResponse, options: dict = {}) -> None:
+        # built-in participants run on the server event loop and must not block,
+        # extension participants are called in a worker thread with their own event loop
         raise NotImplemented
     
     async def handle_chat_request_with_tools(self, request: ChatRequest, response: ChatResponse, options: dict = {}, tool_context: dict = {}, tool_choice = 'auto') -> None:
@@ -487,7 +523,7 @@ class ChatParticipant:
             ] + messages
 
         if len(tools) == 0:
-            request.host.chat_model.completions(messages, tools=None, cancel_token=request.cancel_token, response=response)
+            await request.host.chat_model.acompletions(messages, tools=None, cancel_token=request.cancel_token, response=response)
             return
 
         openai_tools = [tool.schema for tool in tools]
@@ -502,7 +538,7 @@ class ChatParticipant:
                 if request.cancel_token.is_cancel_requested:
                     return
 
-                tool_response = request.host.chat_model.completions(messages, openai_tools, cancel_token=request.cancel_token, options=options)
+                tool_response = await request.host.chat_model.acompletions(messages, openai_tools, cancel_token=request.cancel_token, options=options)
                 # after first call, set tool_choice to auto
                 options['tool_choice'] = 'auto'
 
@@ -608,6 +644,10 @@ class CompletionContextProvider:
     def handle_completion_context_request(self, request: ContextRequest) -> CompletionContext:
         raise NotImplemented
 
+    async def ahandle_completion_context_request(self, request: ContextRequest) -> CompletionContext:
+        # providers without native async support run the blocking call in a worker thread
+        return await asyncio.to_thread(self.handle_completion_context_request, request)
+
 @dataclass
 class LLMProviderProperty:
     id: str
@@ -667,10 +707,17 @@ class ChatModel(AIModel):
     def completions(self, messages: list[dict], tools: list[dict] = None, response: ChatResponse = None, cancel_token: CancelToken = None, options: dict = {}) -> Any:
         raise NotImplemented
 
+    async def acompletions(self, messages: list[dict], tools: list[dict] = None, response: ChatResponse = None, cancel_token: CancelToken = None, options: dict = {}) -> Any:
+        # models without native async support run the blocking call in a worker thread
+        return await asyncio.to_thread(self.completions, messages, tools, response, cancel_token, options)
+
 class InlineCompletionModel(AIModel):
     def inline_completions(prefix, suffix, language, filename, context: CompletionContext, cancel_token: CancelToken) -> str:
         raise NotImplemented
 
+    async def ainline_completions(self, prefix, suffix, language, filename, context: CompletionContext, cancel_token: CancelToken) -> str:
+        return await asyncio.to_thread(self.inline_completions, prefix, suffix, language, filename, context, cancel_token)
+
 class EmbeddingModel(AIModel):
     def embeddings(self, inputs: list[str]) -> Any:
         raise NotImplemented
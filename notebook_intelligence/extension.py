@@ -1,6 +1,7 @@
 # Copyright (c) Mehmet Bektas <mbektasgh@outlook.com>
 
 import asyncio
+from collections import deque
 from dataclasses import dataclass
 import json
 from os import path
@@ -10,6 +11,7 @@ from typing import Union
 import uuid
 import threading
 import logging
+import hashlib
 import tiktoken
 
 from jupyter_server.extension.application import ExtensionApp
@@ -18,17 +20,58 @@ from jupyter_server.utils import url_path_join
 import tornado
 from tornado import websocket
 from traitlets import Unicode
-from notebook_intelligence.api import BuiltinToolset, CancelToken, ChatMode, ChatResponse, ChatRequest, ContextRequest, ContextRequestType, RequestDataType, RequestToolSelection, ResponseStreamData, ResponseStreamDataType, BackendMessageType, SignalImpl
+from notebook_intelligence.api import BuiltinToolset, CancelTokenImpl, ChatMode, ChatResponse, ChatRequest, ContextRequest, ContextRequestType, RequestDataType, RequestToolSelection, ResponseStreamData, ResponseStreamDataType, BackendMessageType
 from notebook_intelligence.ai_service_manager import AIServiceManager
 import notebook_intelligence.github_copilot as github_copilot
 from notebook_intelligence.built_in_toolsets import built_in_toolsets
-from notebook_intelligence.util import ThreadSafeWebSocketConnector
+from notebook_intelligence.util import json_dumps_bytes, json_loads, ThreadSafeWebSocketConnector
 
 ai_service_manager: AIServiceManager = None
 log = logging.getLogger(__name__)
-tiktoken_encoding = tiktoken.encoding_for_model('gpt-4o')
 thread_safe_websocket_connector: ThreadSafeWebSocketConnector = None
 
+# loading the encoding takes a few hundred ms, it is loaded on a background
+# thread at extension start instead of at import or on the first chat request
+_tiktoken_encoding: tiktoken.Encoding = None
+_tiktoken_encoding_lock = threading.Lock()
+
+def get_tiktoken_encoding() -> tiktoken.Encoding:
+    global _tiktoken_encoding
+    with _tiktoken_encoding_lock:
+        if _tiktoken_encoding is None:
+            encoding = tiktoken.encoding_for_model('gpt-4o')
+            encoding.encode_ordinary("warmup")
+            _tiktoken_encoding = encoding
+    return _tiktoken_encoding
+
+TOKEN_COUNT_CACHE_MAX_SIZE = 512
+# sha1 of text -> token count, evicted in insertion order
+_token_count_cache: dict[bytes, int] = {}
+
+def _token_count_cache_key(text: str) -> bytes:
+    return hashlib.sha1(text.encode('utf-8', errors='surrogatepass')).digest()
+
+def _cache_token_count(key: bytes, token_count: int) -> None:
+    if len(_token_count_cache) >= TOKEN_COUNT_CACHE_MAX_SIZE:
+        _token_count_cache.pop(next(iter(_token_count_cache)))
+    _token_count_cache[key] = token_count
+
+def _truncate_to_token_budget(text: str, token_budget: float) -> str:
+    # a token is at least one utf-8 byte and a character at most four,
+    # so short texts fit in the budget without encoding them
+    if 4 * len(text) <= token_budget:
+        return text
+    key = _token_count_cache_key(text)
+    token_count = _token_count_cache.get(key)
+    if token_count is not None and token_count <= token_budget:
+        return text
+    tiktoken_encoding = get_tiktoken_encoding()
+    tokens = tiktoken_encoding.encode_ordinary(text)
+    _cache_token_count(key, len(tokens))
+    if len(tokens) <= token_budget:
+        return text
+    return tiktoken_encoding.decode(tokens[:int(token_budget)]) + "..."
+
 class GetCapabilitiesHandler(APIHandler):
     notebook_execute_tool = 'enabled'
 
@@ -81,7 +124,7 @@ class GetCapabilitiesHandler(APIHandler):
             "chat_model": nbi_config.chat_model,
             "inline_completion_model": nbi_config.inline_completion_model,
             "embedding_model": nbi_config.embedding_model,
-            "chat_participants": [],
+            "chat_participants": ai_service_manager.chat_participant_capabilities,
             "store_github_access_token": nbi_config.store_github_access_token,
             "tool_config": {
                 "builtinToolsets": allowed_builtin_toolsets,
@@ -91,15 +134,6 @@ class GetCapabilitiesHandler(APIHandler):
             "mcp_server_settings": nbi_config.mcp_server_settings,
             "default_chat_mode": nbi_config.default_chat_mode
         }
-        for participant_id in ai_service_manager.chat_participants:
-            participant = ai_service_manager.chat_participants[participant_id]
-            response["chat_participants"].append({
-                "id": participant.id,
-                "name": participant.name,
-                "description": participant.description,
-                "iconPath": participant.icon_path,
-                "commands": [command.name for command in participant.commands]
-            })
         self.finish(json.dumps(response))
 
 class ConfigHandler(APIHandler):
@@ -127,6 +161,8 @@ class ConfigHandler(APIHandler):
         ai_service_manager.nbi_config.save()
         if has_model_change:
             ai_service_manager.update_models_from_config()
+            # model property values are part of the model id lists
+            ai_service_manager.invalidate_model_id_cache()
         self.finish(json.dumps({}))
 
 class UpdateProviderModelsHandler(APIHandler):
@@ -209,39 +245,120 @@ class ChatHistory:
     MAX_MESSAGES = 10
 
     def __init__(self):
-        self.messages = {}
+        self.messages: dict[str, deque] = {}
+        # participant of the last user message, key is chat id
+        self._last_user_participant: dict[str, str] = {}
 
     def clear(self, chatId = None):
         if chatId is None:
             self.messages = {}
+            self._last_user_participant = {}
             return True
         elif chatId in self.messages:
             del self.messages[chatId]
+            self._last_user_participant.pop(chatId, None)
             return True
 
         return False
 
     def add_message(self, chatId, message):
+        self.add_messages(chatId, [message])
+
+    def add_messages(self, chatId, messages):
+        """
+        Add messages of a single turn, the participant check uses the
+        last user message in the list
+        """
         if chatId not in self.messages:
-            self.messages[chatId] = []
+            self.messages[chatId] = deque(maxlen=ChatHistory.MAX_MESSAGES)
 
         # clear the chat history if participant changed
-        if message["role"] == "user":
-            existing_messages = self.messages[chatId]
-            prev_user_message = next((m for m in reversed(existing_messages) if m["role"] == "user"), None)
-            if prev_user_message is not None:
-                (current_participant, command, prompt) = AIServiceManager.parse_prompt(message["content"])
-                (prev_participant, command, prompt) = AIServiceManager.parse_prompt(prev_user_message["content"])
-                if current_participant != prev_participant:
-                    self.messages[chatId] = []
-
-        self.messages[chatId].append(message)
-        # limit number of messages kept in history
-        if len(self.messages[chatId]) > ChatHistory.MAX_MESSAGES:
-            self.messages[chatId] = self.messages[chatId][-ChatHistory.MAX_MESSAGES:]
+        last_user_message = next((message for message in reversed(messages) if message["role"] == "user"), None)
+        if last_user_message is not None:
+            (current_participant, command, prompt) = AIServiceManager.parse_prompt(last_user_message["content"])
+            prev_participant = self._last_user_participant.get(chatId)
+            if prev_participant is not None and current_participant != prev_participant:
+                self.messages[chatId].clear()
+            self._last_user_participant[chatId] = current_participant
+
+        # deque drops the oldest messages past MAX_MESSAGES
+        self.messages[chatId].extend(messages)
+
+    def get_history(self, chatId):
+        return list(self.messages.get(chatId, ()))
+
+    def get_history_view(self, chatId) -> tuple:
+        return tuple(self.messages.get(chatId, ()))
+
+class _NullChatHistory(ChatHistory):
+    """
+    Chat history that keeps no messages, for responses without a chat
+    """
+    def add_messages(self, chatId, messages):
+        pass
 
     def get_history(self, chatId):
-        return self.messages.get(chatId, [])
+        return []
+
+    def get_history_view(self, chatId) -> tuple:
+        return ()
+
+# shared by inline completion responses, they don't use chat history
+_NULL_CHAT_HISTORY = _NullChatHistory()
+
+# builders of the nbiContent payload of stream messages, key is response data type
+_NBI_CONTENT_BUILDERS = {
+    ResponseStreamDataType.Markdown: lambda data: {
+        "type": data.data_type,
+        "content": data.content,
+        "detail": data.detail
+    },
+    ResponseStreamDataType.MarkdownPart: lambda data: {
+        "type": data.data_type,
+        "content": data.content
+    },
+    ResponseStreamDataType.Image: lambda data: {
+        "type": data.data_type,
+        "content": data.content
+    },
+    ResponseStreamDataType.HTMLFrame: lambda data: {
+        "type": data.data_type,
+        "content" : {
+            "source": data.source,
+            "height": data.height
+        }
+    },
+    ResponseStreamDataType.Anchor: lambda data: {
+        "type": data.data_type,
+        "content": {
+            "uri": data.uri,
+            "title": data.title
+        }
+    },
+    ResponseStreamDataType.Button: lambda data: {
+        "type": data.data_type,
+        "content": {
+            "title": data.title,
+            "commandId": data.commandId,
+            "args": data.args if data.args is not None else {}
+        }
+    },
+    ResponseStreamDataType.Progress: lambda data: {
+        "type": data.data_type,
+        "content": data.title
+    },
+    ResponseStreamDataType.Confirmation: lambda data: {
+        "type": data.data_type,
+        "content": {
+            "title": data.title,
+            "message": data.message,
+            "confirmArgs": data.confirmArgs if data.confirmArgs is not None else {},
+            "cancelArgs": data.cancelArgs if data.cancelArgs is not None else {},
+            "confirmLabel": data.confirmLabel if data.confirmLabel is not None else "Approve",
+            "cancelLabel": data.cancelLabel if data.cancelLabel is not None else "Cancel"
+        }
+    }
+}
 
 class WebsocketCopilotResponseEmitter(ChatResponse):
     def __init__(self, chatId, messageId, websocket_handler, chat_history):
@@ -251,6 +368,8 @@ class WebsocketCopilotResponseEmitter(ChatResponse):
         self.websocket_handler = websocket_handler
         self.chat_history = chat_history
         self.streamed_contents = []
+        # (participant id, encoded stream message fields before data)
+        self._stream_message_prefix: tuple[str, bytes] = None
 
     @property
     def chat_id(self) -> str:
@@ -261,178 +380,116 @@ class WebsocketCopilotResponseEmitter(ChatResponse):
         return self.messageId
 
     def stream(self, data: Union[ResponseStreamData, dict]):
-        data_type = ResponseStreamDataType.LLMRaw if type(data) is dict else data.data_type
+        # encode the static fields once, only the data and timestamp are serialized per chunk
+        self._send_message(
+            self._get_stream_message_prefix() +
+            json_dumps_bytes(self._create_stream_data(data)) +
+            b',"created":' + json_dumps_bytes(dt.datetime.now().isoformat()) + b'}'
+        )
+
+    def _get_stream_message_prefix(self) -> bytes:
+        # participant id is set by the service manager after the emitter is created
+        if self._stream_message_prefix is None or self._stream_message_prefix[0] != self.participant_id:
+            envelope = json_dumps_bytes({
+                "id": self.messageId,
+                "participant": self.participant_id,
+                "type": BackendMessageType.StreamMessage
+            })
+            self._stream_message_prefix = (self.participant_id, envelope[:-1] + b',"data":')
+        return self._stream_message_prefix[1]
 
-        if data_type == ResponseStreamDataType.Markdown:
-            self.chat_history.add_message(self.chatId, {"role": "assistant", "content": data.content})
-            data = {
-                "choices": [
-                    {
-                        "delta": {
-                            "nbiContent": {
-                                "type": data_type,
-                                "content": data.content,
-                                "detail": data.detail
-                            },
-                            "content": "",
-                            "role": "assistant"
-                        }
-                    }
-                ]
-            }
-        elif data_type == ResponseStreamDataType.Image:
-            data = {
-                "choices": [
-                    {
-                        "delta": {
-                            "nbiContent": {
-                                "type": data_type,
-                                "content": data.content
-                            },
-                            "content": "",
-                            "role": "assistant"
-                        }
-                    }
-                ]
-            }
-        elif data_type == ResponseStreamDataType.HTMLFrame:
-            data = {
-                "choices": [
-                    {
-                        "delta": {
-                            "nbiContent": {
-                                "type": data_type,
-                                "content" : {
-                                    "source": data.source,
-                                    "height": data.height
-                                }
-                            },
-                            "content": "",
-                            "role": "assistant"
-                        }
-                    }
-                ]
-            }
-        elif data_type == ResponseStreamDataType.Anchor:
-            data = {
-                "choices": [
-                    {
-                        "delta": {
-                            "nbiContent": {
-                                "type": data_type,
-                                "content": {
-                                    "uri": data.uri,
-                                    "title": data.title
-                                }
-                            },
-                            "content": "",
-                            "role": "assistant"
-                        }
-                    }
-                ]
-            }
-        elif data_type == ResponseStreamDataType.Button:
-            data = {
-                "choices": [
-                    {
-                        "delta": {
-                            "nbiContent": {
-                                "type": data_type,
-                                "content": {
-                                    "title": data.title,
-                                    "commandId": data.commandId,
-                                    "args": data.args if data.args is not None else {}
-                                }
-                            },
-                            "content": "",
-                            "role": "assistant"
-                        }
-                    }
-                ]
-            }
-        elif data_type == ResponseStreamDataType.Progress:
-            data = {
-                "choices": [
-                    {
-                        "delta": {
-                            "nbiContent": {
-                                "type": data_type,
-                                "content": data.title
-                            },
-                            "content": "",
-                            "role": "assistant"
-                        }
-                    }
-                ]
-            }
-        elif data_type == ResponseStreamDataType.Confirmation:
-            data = {
-                "choices": [
-                    {
-                        "delta": {
-                            "nbiContent": {
-                                "type": data_type,
-                                "content": {
-                                    "title": data.title,
-                                    "message": data.message,
-                                    "confirmArgs": data.confirmArgs if data.confirmArgs is not None else {},
-                                    "cancelArgs": data.cancelArgs if data.cancelArgs is not None else {},
-                                    "confirmLabel": data.confirmLabel if data.confirmLabel is not None else "Approve",
-                                    "cancelLabel": data.cancelLabel if data.cancelLabel is not None else "Cancel"
-                                }
-                            },
-                            "content": "",
-                            "role": "assistant"
-                        }
-                    }
-                ]
-            }
-        elif data_type == ResponseStreamDataType.MarkdownPart:
-            content = data.content
+    def _create_stream_message(self, data: Union[ResponseStreamData, dict]) -> dict:
+        return {
+            "id": self.messageId,
+            "participant": self.participant_id,
+            "type": BackendMessageType.StreamMessage,
+            "data": self._create_stream_data(data),
+            "created": dt.datetime.now().isoformat()
+        }
+
+    def _create_stream_data(self, data: Union[ResponseStreamData, dict]) -> dict:
+        if type(data) is dict: # ResponseStreamDataType.LLMRaw
+            if len(data.get("choices", [])) > 0:
+                part = data["choices"][0].get("delta", {}).get("content", "")
+                if part is not None:
+                    self.streamed_contents.append(part)
+        else:
+            data_type = data.data_type
+            if data_type == ResponseStreamDataType.Markdown:
+                self.chat_history.add_message(self.chatId, {"role": "assistant", "content": data.content})
+            elif data_type == ResponseStreamDataType.MarkdownPart:
+                if data.content is not None:
+                    self.streamed_contents.append(data.content)
             data = {
                 "choices": [
                     {
                         "delta": {
-                            "nbiContent": {
-                                "type": data_type,
-                                "content": data.content
-                            },
+                            "nbiContent": _NBI_CONTENT_BUILDERS[data_type](data),
                             "content": "",
                             "role": "assistant"
                         }
                     }
                 ]
             }
-            part = content
-            if part is not None:
-                self.streamed_contents.append(part)
-        else: # ResponseStreamDataType.LLMRaw
-            if len(data.get("choices", [])) > 0:
-                part = data["choices"][0].get("delta", {}).get("content", "")
-                if part is not None:
-                    self.streamed_contents.append(part)
 
-        self.websocket_handler.write_message({
-            "id": self.messageId,
-            "participant": self.participant_id,
-            "type": BackendMessageType.StreamMessage,
-            "data": data,
-            "created": dt.datetime.now().isoformat()
-        })
+        return data
+
+    def stream_batch(self, data: list[Union[ResponseStreamData, dict]]):
+        # merge consecutive text-only LLM deltas into a single message
+        items = []
+        merged_contents = []
+        for item in data:
+            content = WebsocketCopilotResponseEmitter._get_text_delta_content(item)
+            if content is not None:
+                merged_contents.append(content)
+                continue
+            if len(merged_contents) > 0:
+                items.append({"choices": [{"delta": {"content": "".join(merged_contents), "role": "assistant"}}]})
+                merged_contents = []
+            items.append(item)
+        if len(merged_contents) > 0:
+            items.append({"choices": [{"delta": {"content": "".join(merged_contents), "role": "assistant"}}]})
+
+        if len(items) == 1:
+            self.stream(items[0])
+        elif len(items) > 1:
+            # send the whole batch in a single frame, frontend unpacks it
+            self._send_message({
+                "id": self.messageId,
+                "participant": self.participant_id,
+                "type": BackendMessageType.StreamMessage,
+                "batch": [self._create_stream_message(item) for item in items]
+            })
+
+    @staticmethod
+    def _get_text_delta_content(data: Union[ResponseStreamData, dict]) -> Union[str, None]:
+        if type(data) is not dict:
+            return None
+        choices = data.get("choices")
+        if choices is None or len(choices) != 1:
+            return None
+        delta = choices[0].get("delta")
+        if delta is None or choices[0].get("finish_reason") is not None or not delta.keys() <= {"content", "role"}:
+            return None
+        content = delta.get("content")
+        return content if type(content) is str else None
 
     def finish(self) -> None:
+        self.complete({})
+
+    def complete(self, data: dict) -> None:
         self.chat_history.add_message(self.chatId, {"role": "assistant", "content": "".join(self.streamed_contents)})
         self.streamed_contents = []
-        self.websocket_handler.write_message({
+        self._send_message({
             "id": self.messageId,
             "participant": self.participant_id,
             "type": BackendMessageType.StreamEnd,
-            "data": {}
+            "data": data
         })
 
     async def run_ui_command(self, command: str, args: dict = {}) -> None:
         callback_id = str(uuid.uuid4())
-        self.websocket_handler.write_message({
+        self._send_message({
             "id": self.messageId,
             "participant": self.participant_id,
             "type": BackendMessageType.RunUICommand,
@@ -445,14 +502,20 @@ class WebsocketCopilotResponseEmitter(ChatResponse):
         response = await ChatResponse.wait_for_run_ui_command_response(self, callback_id)
         return response
 
-class CancelTokenImpl(CancelToken):
-    def __init__(self):
-        super().__init__()
-        self._cancellation_signal = SignalImpl()
+    def _send_message(self, message: Union[dict, bytes]) -> None:
+        if self.websocket_handler.is_closed:
+            return
+        # most responses are generated on the IOLoop, extension participants and tools
+        # and the Copilot http loop call in from other threads. add_callback is
+        # thread-safe and runs callbacks in order
+        self.websocket_handler.io_loop.add_callback(self._write_message, message)
 
-    def cancel_request(self) -> None:
-        self._cancellation_requested = True
-        self._cancellation_signal.emit()
+    def _write_message(self, message: Union[dict, bytes]) -> None:
+        try:
+            # send UTF-8 JSON as a binary frame, frontend decodes it
+            self.websocket_handler.write_message(message if type(message) is bytes else json_dumps_bytes(message), binary=True)
+        except websocket.WebSocketClosedError:
+            log.debug(f"Websocket closed, dropping message for {self.messageId}")
 
 @dataclass
 class MessageCallbackHandlers:
@@ -464,6 +527,8 @@ class WebsocketCopilotHandler(websocket.WebSocketHandler):
         super().__init__(application, request, **kwargs)
         # TODO: cleanup
         self._messageCallbackHandlers: dict[str, MessageCallbackHandlers] = {}
+        self.io_loop = tornado.ioloop.IOLoop.current()
+        self.is_closed = False
         self.chat_history = ChatHistory()
         ws_connector = ThreadSafeWebSocketConnector(self)
         ai_service_manager.websocket_connector = ws_connector
@@ -473,113 +538,124 @@ class WebsocketCopilotHandler(websocket.WebSocketHandler):
         pass
 
     def on_message(self, message):
-        msg = json.loads(message)
-
-        messageId = msg['id']
-        messageType = msg['type']
-        if messageType == RequestDataType.ChatRequest:
-            data = msg['data']
-            chatId = data['chatId']
-            prompt = data['prompt']
-            language = data['language']
-            filename = data['filename']
-            additionalContext = data.get('additionalContext', [])
-            chat_mode = ChatMode('agent', 'Agent') if data.get('chatMode', 'ask') == 'agent' else ChatMode('ask', 'Ask')
-            toolSelections = data.get('toolSelections', {})
-            tool_selection = RequestToolSelection(
-                built_in_toolsets=toolSelections.get('builtinToolsets', []),
-                mcp_server_tools=toolSelections.get('mcpServers', {}),
-                extension_tools=toolSelections.get('extensions', {})
-            )
-
-            request_chat_history = self.chat_history.get_history(chatId).copy()
-
-            token_limit = 100 if ai_service_manager.chat_model is None else ai_service_manager.chat_model.context_window
-            token_budget =  0.8 * token_limit
-
-            for context in additionalContext:
-                file_path = context["filePath"]
-                file_path = path.join(NotebookIntelligence.root_dir, file_path)
-                filename = path.basename(file_path)
-                start_line = context["startLine"]
-                end_line = context["endLine"]
-                current_cell_contents = context["currentCellContents"]
-                current_cell_input = current_cell_contents["input"] if current_cell_contents is not None else ""
-                current_cell_output = current_cell_contents["output"] if current_cell_contents is not None else ""
-                current_cell_context = f"This is a Jupyter notebook and currently selected cell input is: ```{current_cell_input}``` and currently selected cell output is: ```{current_cell_output}```. If user asks a question about 'this' cell then assume that user is referring to currently selected cell." if current_cell_contents is not None else ""
-                context_content = context["content"]
-                token_count = len(tiktoken_encoding.encode(context_content))
-                if token_count > token_budget:
-                    context_content = context_content[:int(token_budget)] + "..."
-
-                request_chat_history.append({"role": "user", "content": f"Use this as additional context: ```{context_content}```. It is from current file: '{filename}' at path '{file_path}', lines: {start_line} - {end_line}. {current_cell_context}"})
-                self.chat_history.add_message(chatId, {"role": "user", "content": f"This file was provided as additional context: '{filename}' at path '{file_path}', lines: {start_line} - {end_line}. {current_cell_context}"})
-
-            self.chat_history.add_message(chatId, {"role": "user", "content": prompt})
-            request_chat_history.append({"role": "user", "content": prompt})
-            response_emitter = WebsocketCopilotResponseEmitter(chatId, messageId, self, self.chat_history)
-            cancel_token = CancelTokenImpl()
-            self._messageCallbackHandlers[messageId] = MessageCallbackHandlers(response_emitter, cancel_token)
-            thread = threading.Thread(target=asyncio.run, args=(ai_service_manager.handle_chat_request(ChatRequest(chat_mode=chat_mode, tool_selection=tool_selection, prompt=prompt, chat_history=request_chat_history, cancel_token=cancel_token), response_emitter),))
-            thread.start()
-        elif messageType == RequestDataType.GenerateCode:
-            data = msg['data']
-            chatId = data['chatId']
-            prompt = data['prompt']
-            prefix = data['prefix']
-            suffix = data['suffix']
-            existing_code = data['existingCode']
-            language = data['language']
-            filename = data['filename']
-            chat_mode = ChatMode('ask', 'Ask')
-            if prefix != '':
-                self.chat_history.add_message(chatId, {"role": "user", "content": f"This code section comes before the code section you will generate, use as context. Leading content: ```{prefix}```"})
-            if suffix != '':
-                self.chat_history.add_message(chatId, {"role": "user", "content": f"This code section comes after the code section you will generate, use as context. Trailing content: ```{suffix}```"})
-            if existing_code != '':
-                self.chat_history.add_message(chatId, {"role": "user", "content": f"You are asked to modify the existing code. Generate a replacement for this existing code : ```{existing_code}```"})
-            self.chat_history.add_message(chatId, {"role": "user", "content": f"Generate code for: {prompt}"})
-            response_emitter = WebsocketCopilotResponseEmitter(chatId, messageId, self, self.chat_history)
-            cancel_token = CancelTokenImpl()
-            self._messageCallbackHandlers[messageId] = MessageCallbackHandlers(response_emitter, cancel_token)
-            existing_code_message = " Update the existing code section and return a modified version. Don't just return the update, recreate the existing code section with the update." if existing_code != '' else ''
-            thread = threading.Thread(target=asyncio.run, args=(ai_service_manager.handle_chat_request(ChatRequest(chat_mode=chat_mode, prompt=prompt, chat_history=self.chat_history.get_history(chatId), cancel_token=cancel_token), response_emitter, options={"system_prompt": f"You are an assistant that generates code for '{language}' language. You generate code between existing leading and trailing code sections.{existing_code_message} Be concise and return only code as a response. Don't include leading content or trailing content in your response, they are provided only for context. You can reuse methods and symbols defined in leading and trailing content."}),))
-            thread.start()
-        elif messageType == RequestDataType.InlineCompletionRequest:
-            data = msg['data']
-            chatId = data['chatId']
-            prefix = data['prefix']
-            suffix = data['suffix']
-            language = data['language']
-            filename = data['filename']
-            chat_history = ChatHistory()
-
-            response_emitter = WebsocketCopilotResponseEmitter(chatId, messageId, self, chat_history)
-            cancel_token = CancelTokenImpl()
-            self._messageCallbackHandlers[messageId] = MessageCallbackHandlers(response_emitter, cancel_token)
-
-            thread = threading.Thread(target=asyncio.run, args=(WebsocketCopilotHandler.handle_inline_completions(prefix, suffix, language, filename, response_emitter, cancel_token),))
-            thread.start()
-        elif messageType == RequestDataType.ChatUserInput:
-            handlers = self._messageCallbackHandlers.get(messageId)
-            if handlers is None:
-                return
-            handlers.response_emitter.on_user_input(msg['data'])
-        elif messageType == RequestDataType.ClearChatHistory:
-            self.chat_history.clear()
-        elif messageType == RequestDataType.RunUICommandResponse:
-            handlers = self._messageCallbackHandlers.get(messageId)
-            if handlers is None:
-                return
-            handlers.response_emitter.on_run_ui_command_response(msg['data'])
-        elif messageType == RequestDataType.CancelChatRequest or  messageType == RequestDataType.CancelInlineCompletionRequest:
-            handlers = self._messageCallbackHandlers.get(messageId)
-            if handlers is None:
-                return
-            handlers.cancel_token.cancel_request()
- 
+        msg = json_loads(message)
+
+        handler = WebsocketCopilotHandler._MESSAGE_HANDLERS.get(msg['type'])
+        if handler is not None:
+            handler(self, msg['id'], msg.get('data'))
+
+    def _handle_chat_request(self, messageId, data):
+        chatId = data['chatId']
+        prompt = data['prompt']
+        language = data['language']
+        filename = data['filename']
+        additionalContext = data.get('additionalContext', [])
+        chat_mode = ChatMode('agent', 'Agent') if data.get('chatMode', 'ask') == 'agent' else ChatMode('ask', 'Ask')
+        toolSelections = data.get('toolSelections', {})
+        tool_selection = RequestToolSelection(
+            built_in_toolsets=toolSelections.get('builtinToolsets', []),
+            mcp_server_tools=toolSelections.get('mcpServers', {}),
+            extension_tools=toolSelections.get('extensions', {})
+        )
+
+        history = self.chat_history.get_history_view(chatId)
+        context_messages = []
+        history_messages = []
+
+        token_limit = 100 if ai_service_manager.chat_model is None else ai_service_manager.chat_model.context_window
+        token_budget =  0.8 * token_limit
+
+        root_dir = path.realpath(NotebookIntelligence.root_dir)
+        for context in additionalContext:
+            # context paths are relative to the server root, an absolute path would make join drop root_dir
+            file_path = path.realpath(path.join(root_dir, context["filePath"].lstrip("/\\")))
+            if path.commonpath([root_dir, file_path]) != root_dir:
+                log.warning(f"Ignoring additional context outside of the server root: {context['filePath']}")
+                continue
+            filename = path.basename(file_path)
+            start_line = context["startLine"]
+            end_line = context["endLine"]
+            current_cell_contents = context["currentCellContents"]
+            current_cell_input = current_cell_contents["input"] if current_cell_contents is not None else ""
+            current_cell_output = current_cell_contents["output"] if current_cell_contents is not None else ""
+            current_cell_context = f"This is a Jupyter notebook and currently selected cell input is: ```{current_cell_input}``` and currently selected cell output is: ```{current_cell_output}```. If user asks a question about 'this' cell then assume that user is referring to currently selected cell." if current_cell_contents is not None else ""
+            context_content = context["content"]
+            context_content = _truncate_to_token_budget(context_content, token_budget)
+
+            context_messages.append({"role": "user", "content": f"Use this as additional context: ```{context_content}```. It is from current file: '{filename}' at path '{file_path}', lines: {start_line} - {end_line}. {current_cell_context}"})
+            history_messages.append({"role": "user", "content": f"This file was provided as additional context: '{filename}' at path '{file_path}', lines: {start_line} - {end_line}. {current_cell_context}"})
+
+        prompt_message = {"role": "user", "content": prompt}
+        self.chat_history.add_messages(chatId, [*history_messages, prompt_message])
+        request_chat_history = [*history, *context_messages, prompt_message]
+        response_emitter = WebsocketCopilotResponseEmitter(chatId, messageId, self, self.chat_history)
+        cancel_token = CancelTokenImpl()
+        self._messageCallbackHandlers[messageId] = MessageCallbackHandlers(response_emitter, cancel_token)
+        self.io_loop.spawn_callback(ai_service_manager.handle_chat_request, ChatRequest(chat_mode=chat_mode, tool_selection=tool_selection, prompt=prompt, chat_history=request_chat_history, cancel_token=cancel_token), response_emitter)
+
+    def _handle_generate_code(self, messageId, data):
+        chatId = data['chatId']
+        prompt = data['prompt']
+        prefix = data['prefix']
+        suffix = data['suffix']
+        existing_code = data['existingCode']
+        language = data['language']
+        filename = data['filename']
+        chat_mode = ChatMode('ask', 'Ask')
+        history_messages = []
+        if prefix != '':
+            history_messages.append({"role": "user", "content": f"This code section comes before the code section you will generate, use as context. Leading content: ```{prefix}```"})
+        if suffix != '':
+            history_messages.append({"role": "user", "content": f"This code section comes after the code section you will generate, use as context. Trailing content: ```{suffix}```"})
+        if existing_code != '':
+            history_messages.append({"role": "user", "content": f"You are asked to modify the existing code. Generate a replacement for this existing code : ```{existing_code}```"})
+        history_messages.append({"role": "user", "content": f"Generate code for: {prompt}"})
+        self.chat_history.add_messages(chatId, history_messages)
+        response_emitter = WebsocketCopilotResponseEmitter(chatId, messageId, self, self.chat_history)
+        cancel_token = CancelTokenImpl()
+        self._messageCallbackHandlers[messageId] = MessageCallbackHandlers(response_emitter, cancel_token)
+        existing_code_message = " Update the existing code section and return a modified version. Don't just return the update, recreate the existing code section with the update." if existing_code != '' else ''
+        self.io_loop.spawn_callback(ai_service_manager.handle_chat_request, ChatRequest(chat_mode=chat_mode, prompt=prompt, chat_history=self.chat_history.get_history(chatId), cancel_token=cancel_token), response_emitter, options={"system_prompt": f"You are an assistant that generates code for '{language}' language. You generate code between existing leading and trailing code sections.{existing_code_message} Be concise and return only code as a response. Don't include leading content or trailing content in your response, they are provided only for context. You can reuse methods and symbols defined in leading and trailing content."})
+
+    def _handle_inline_completion_request(self, messageId, data):
+        chatId = data['chatId']
+        prefix = data['prefix']
+        suffix = data['suffix']
+        language = data['language']
+        filename = data['filename']
+        response_emitter = WebsocketCopilotResponseEmitter(chatId, messageId, self, _NULL_CHAT_HISTORY)
+        cancel_token = CancelTokenImpl()
+        self._messageCallbackHandlers[messageId] = MessageCallbackHandlers(response_emitter, cancel_token)
+
+        self.io_loop.spawn_callback(WebsocketCopilotHandler.handle_inline_completions, prefix, suffix, language, filename, response_emitter, cancel_token)
+
+    def _handle_chat_user_input(self, messageId, data):
+        handlers = self._messageCallbackHandlers.get(messageId)
+        if handlers is None:
+            return
+        handlers.response_emitter.on_user_input(data)
+
+    def _handle_clear_chat_history(self, messageId, data):
+        self.chat_history.clear()
+
+    def _handle_run_ui_command_response(self, messageId, data):
+        handlers = self._messageCallbackHandlers.get(messageId)
+        if handlers is None:
+            return
+        handlers.response_emitter.on_run_ui_command_response(data)
+
+    def _handle_cancel_request(self, messageId, data):
+        handlers = self._messageCallbackHandlers.get(messageId)
+        if handlers is None:
+            return
+        handlers.cancel_token.cancel_request()
+
     def on_close(self):
-        pass
+        self.is_closed = True
+        # stop in-flight requests, their responses can no longer be delivered
+        for handlers in self._messageCallbackHandlers.values():
+            handlers.cancel_token.cancel_request()
+        self._messageCallbackHandlers.clear()
 
     async def handle_inline_completions(prefix, suffix, language, filename, response_emitter, cancel_token):
         if ai_service_manager.inline_completion_model is None:
@@ -592,13 +668,24 @@ class WebsocketCopilotHandler(websocket.WebSocketHandler):
             response_emitter.finish()
             return
 
-        completions = ai_service_manager.inline_completion_model.inline_completions(prefix, suffix, language, filename, context, cancel_token)
+        completions = await ai_service_manager.inline_completion_model.ainline_completions(prefix, suffix, language, filename, context, cancel_token)
         if cancel_token.is_cancel_requested:
             response_emitter.finish()
             return
 
-        response_emitter.stream({"completions": completions})
-        response_emitter.finish()
+        response_emitter.complete({"completions": completions})
+
+    # request message type -> handler method
+    _MESSAGE_HANDLERS = {
+        RequestDataType.ChatRequest: _handle_chat_request,
+        RequestDataType.GenerateCode: _handle_generate_code,
+        RequestDataType.InlineCompletionRequest: _handle_inline_completion_request,
+        RequestDataType.ChatUserInput: _handle_chat_user_input,
+        RequestDataType.ClearChatHistory: _handle_clear_chat_history,
+        RequestDataType.RunUICommandResponse: _handle_run_ui_command_response,
+        RequestDataType.CancelChatRequest: _handle_cancel_request,
+        RequestDataType.CancelInlineCompletionRequest: _handle_cancel_request,
+    }
 
 class NotebookIntelligence(ExtensionApp):
     name = "notebook_intelligence"
@@ -637,6 +724,7 @@ class NotebookIntelligence(ExtensionApp):
     
     def initialize_ai_service(self, server_root_dir: str):
         global ai_service_manager
+        threading.Thread(target=get_tiktoken_encoding, daemon=True).start()
         ai_service_manager = AIServiceManager({"server_root_dir": server_root_dir})
 
     def initialize_templates(self):
@@ -2,18 +2,24 @@
 #
 # GitHub auth and inline completion sections are derivative of https://github.com/B00TK1D/copilot-api
 
+import asyncio
 import base64
+from collections import OrderedDict
+import copy
 from dataclasses import dataclass
 from enum import Enum
 import os, json, time, requests, threading
-from typing import Any
+from typing import Any, AsyncIterator
 import uuid
 import secrets
-import sseclient
+import hashlib
 import datetime as dt
 import logging
+import aiohttp
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from notebook_intelligence.api import BackendMessageType, CancelToken, ChatResponse, CompletionContext, MarkdownData
-from notebook_intelligence.util import decrypt_with_password, encrypt_with_password, ThreadSafeWebSocketConnector
+from notebook_intelligence.util import decrypt_with_password, encrypt_with_password, json_dumps, json_loads, ThreadSafeWebSocketConnector
 
 from ._version import __version__ as NBI_VERSION
 
@@ -35,8 +41,49 @@ TOKEN_REFRESH_INTERVAL = 1500
 ACCESS_TOKEN_THREAD_SLEEP_INTERVAL = 5
 TOKEN_THREAD_SLEEP_INTERVAL = 3
 TOKEN_FETCH_INTERVAL = 15
+TOKEN_REFRESH_WAIT_TIMEOUT = 10
+HTTP_CONNECTION_LIMIT = 32
+HTTP_KEEPALIVE_TIMEOUT = 60
+PROMPT_CACHE_MAX_SIZE = 200
+PROMPT_CACHE_TTL = 600
+UUID_POOL_SIZE = 64
+STREAM_BATCH_MAX_SIZE = 16
+STREAM_BATCH_INTERVAL = 0.02
 NL = '\n'
 
+# headers sent to the GitHub OAuth device flow endpoints
+_OAUTH_HEADERS = {
+    'accept': 'application/json',
+    'editor-version': EDITOR_VERSION,
+    'editor-plugin-version': EDITOR_PLUGIN_VERSION,
+    'content-type': 'application/json',
+    'user-agent': USER_AGENT,
+    'accept-encoding': 'gzip,deflate,br'
+}
+
+# headers sent to the Copilot token endpoint, without authorization
+_TOKEN_HEADERS = {
+    'editor-version': EDITOR_VERSION,
+    'editor-plugin-version': EDITOR_PLUGIN_VERSION,
+    'user-agent': USER_AGENT
+}
+
+# headers sent to the Copilot API that do not change between requests
+_COPILOT_STATIC_HEADERS = {
+    'editor-version': EDITOR_VERSION,
+    'editor-plugin-version': EDITOR_PLUGIN_VERSION,
+    'user-agent': USER_AGENT,
+    'content-type': 'application/json',
+    'openai-intent': 'conversation-panel',
+    'openai-organization': 'github-copilot',
+    'copilot-integration-id': 'vscode-chat',
+    'vscode-machineid': MACHINE_ID,
+}
+
+# keep-alive session reused by the GitHub auth requests
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=Retry(total=2, backoff_factor=0.2)))
+
 LoginStatus = Enum('LoginStatus', ['NOT_LOGGED_IN', 'ACTIVATING_DEVICE', 'LOGGING_IN', 'LOGGED_IN'])
 
 github_auth = {
@@ -46,19 +93,93 @@ github_auth = {
     "access_token": None,
     "status" : LoginStatus.NOT_LOGGED_IN,
     "token": None,
-    "token_expires_at": dt.datetime.now()
+    "token_expires_at": dt.datetime.now(),
+    "interval": ACCESS_TOKEN_THREAD_SLEEP_INTERVAL
 }
 
 stop_requested = False
-get_access_code_thread = None
-get_token_thread = None
+# future of the _token_lifecycle task, None when not running
+_token_lifecycle_future = None
+_token_lifecycle_lock = threading.Lock()
 last_token_fetch_time = dt.datetime.now() + dt.timedelta(seconds=-TOKEN_FETCH_INTERVAL)
 remember_github_access_token = False
 github_access_token_provided = None
 
+# guards token refreshes so that only one request is in flight at a time
+_token_lock = threading.Lock()
+_token_event = threading.Event()
+_token_refresh_inflight = False
+
+_uuid_pool: list[str] = []
+_uuid_pool_lock = threading.Lock()
+
 websocket_connector: ThreadSafeWebSocketConnector = None
 github_login_status_change_updater_enabled = False
 
+# completion requests run on a dedicated event loop so that a single
+# keep-alive session can be shared by callers running on any thread or loop
+_http_loop: asyncio.AbstractEventLoop = None
+_http_loop_lock = threading.Lock()
+_http_session: aiohttp.ClientSession = None
+
+def _get_http_loop() -> asyncio.AbstractEventLoop:
+    global _http_loop
+    with _http_loop_lock:
+        if _http_loop is None:
+            _http_loop = asyncio.new_event_loop()
+            threading.Thread(target=_http_loop.run_forever, name="nbi-copilot-http", daemon=True).start()
+    return _http_loop
+
+def _get_http_session() -> aiohttp.ClientSession:
+    # must be called from the HTTP loop
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_CONNECTION_LIMIT, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT),
+            timeout=aiohttp.ClientTimeout(total=None),
+            json_serialize=json_dumps,
+            trust_env=True
+        )
+    return _http_session
+
+async def _close_http_session():
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+def _run_on_http_loop(coro):
+    return asyncio.run_coroutine_threadsafe(coro, _get_http_loop())
+
+# cache of non-streamed completion responses, key is the hash of the request
+# payload, value is (expiration time, response). only accessed from the HTTP loop
+_prompt_cache: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+
+def _prompt_cache_key(namespace: str, data: dict) -> str:
+    payload = json_dumps([namespace, data], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _get_cached_response(key: str) -> Any:
+    cached = _prompt_cache.get(key)
+    if cached is None:
+        return None
+    expires_at, cached_response = cached
+    if expires_at < time.monotonic():
+        del _prompt_cache[key]
+        return None
+    _prompt_cache.move_to_end(key)
+    # callers mutate the response (e.g. append tool call ids), return a copy
+    return copy.deepcopy(cached_response)
+
+def _cache_response(key: str, response: dict):
+    _prompt_cache[key] = (time.monotonic() + PROMPT_CACHE_TTL, copy.deepcopy(response))
+    _prompt_cache.move_to_end(key)
+    if len(_prompt_cache) > PROMPT_CACHE_MAX_SIZE:
+        _prompt_cache.popitem(last=False)
+
+def clear_cache():
+    _prompt_cache.clear()
+
 def enable_github_login_status_change_updater(enabled: bool):
     global github_login_status_change_updater_enabled
     github_login_status_change_updater_enabled = enabled
@@ -207,6 +328,8 @@ def logout():
 def handle_stop_request():
     global stop_requested
     stop_requested = True
+    if _http_loop is not None:
+        _run_on_http_loop(_close_http_session())
 
 def get_device_verification_info():
     global github_auth
@@ -215,22 +338,16 @@ def get_device_verification_info():
         "scope": "read:user"
     }
     try:
-        resp = requests.post(f'{GH_WEB_BASE_URL}/login/device/code',
-            headers={
-                'accept': 'application/json',
-                'editor-version': EDITOR_VERSION,
-                'editor-plugin-version': EDITOR_PLUGIN_VERSION,
-                'content-type': 'application/json',
-                'user-agent': USER_AGENT,
-                'accept-encoding': 'gzip,deflate,br'
-            },
-            data=json.dumps(data)
+        resp = _SESSION.post(f'{GH_WEB_BASE_URL}/login/device/code',
+            headers=_OAUTH_HEADERS,
+            data=json_dumps(data)
         )
 
         resp_json = resp.json()
         github_auth["verification_uri"] = resp_json.get('verification_uri')
         github_auth["user_code"] = resp_json.get('user_code')
         github_auth["device_code"] = resp_json.get('device_code')
+        github_auth["interval"] = resp_json.get('interval', ACCESS_TOKEN_THREAD_SLEEP_INTERVAL)
 
         github_auth["status"] = LoginStatus.ACTIVATING_DEVICE
         emit_github_login_status_change()
@@ -244,69 +361,76 @@ def get_device_verification_info():
         "user_code": github_auth["user_code"]
     }
 
-def wait_for_user_access_token_thread_func():
-    global github_auth, get_access_code_thread
+def _poll_user_access_token():
+    data = {
+        "client_id": CLIENT_ID,
+        "device_code": github_auth["device_code"],
+        "grant_type": "urn:ietf:params:oauth:grant-type:device_code"
+    }
+    try:
+        resp = _SESSION.post(f'{GH_WEB_BASE_URL}/login/oauth/access_token',
+            headers=_OAUTH_HEADERS,
+            data=json_dumps(data)
+        )
 
-    if github_access_token_provided is not None:
-        log.info("Using existing GitHub access token")
-        github_auth["access_token"] = github_access_token_provided
-        get_access_code_thread = None
-        return
+        resp_json = resp.json()
+        access_token = resp_json.get('access_token')
 
-    while True:
-        # terminate thread if logged out or stop requested
-        if stop_requested or github_auth["access_token"] is not None or github_auth["device_code"] is None or github_auth["status"] == LoginStatus.NOT_LOGGED_IN:
-            get_access_code_thread = None
-            break
-        data = {
-            "client_id": CLIENT_ID,
-            "device_code": github_auth["device_code"],
-            "grant_type": "urn:ietf:params:oauth:grant-type:device_code"
-        }
-        try:
-            resp = requests.post(f'{GH_WEB_BASE_URL}/login/oauth/access_token',
-                headers={
-                'accept': 'application/json',
-                'editor-version': EDITOR_VERSION,
-                'editor-plugin-version': EDITOR_PLUGIN_VERSION,
-                'content-type': 'application/json',
-                'user-agent': USER_AGENT,
-                'accept-encoding': 'gzip,deflate,br'
-                },
-                data=json.dumps(data)
-            )
-
-            resp_json = resp.json()
-            access_token = resp_json.get('access_token')
-
-            if access_token:
-                github_auth["access_token"] = access_token
-                get_token()
-                get_access_code_thread = None
-                if remember_github_access_token:
-                    store_github_access_token()
-                break
-        except Exception as e:
-            log.error(f"Failed to get access token from GitHub Copilot: {e}")
+        if access_token:
+            github_auth["access_token"] = access_token
+            get_token()
+            if remember_github_access_token:
+                store_github_access_token()
+            return
 
-        time.sleep(ACCESS_TOKEN_THREAD_SLEEP_INTERVAL)
+        # device flow error codes, see RFC 8628 section 3.5
+        error = resp_json.get('error')
+        if error == 'slow_down':
+            github_auth["interval"] = resp_json.get('interval', github_auth["interval"] + 5)
+        elif error == 'expired_token':
+            log.error("GitHub device code expired, login again to get a new code")
+            logout()
+        elif error is not None and error != 'authorization_pending':
+            log.error(f"Failed to get access token from GitHub Copilot: {error}")
+    except Exception as e:
+        log.error(f"Failed to get access token from GitHub Copilot: {e}")
 
 def get_token():
+    global _token_refresh_inflight
+    # single-flight: concurrent callers wait for the refresh in progress
+    # instead of issuing their own request
+    with _token_lock:
+        refresh_inflight = _token_refresh_inflight
+        if not refresh_inflight:
+            _token_refresh_inflight = True
+            _token_event.clear()
+
+    if refresh_inflight:
+        _token_event.wait(timeout=TOKEN_REFRESH_WAIT_TIMEOUT)
+        return
+
+    try:
+        _refresh_token()
+    finally:
+        with _token_lock:
+            _token_refresh_inflight = False
+            _token_event.set()
+
+def _refresh_token():
     global github_auth, github_access_token_provided, API_ENDPOINT, PROXY_ENDPOINT, TOKEN_REFRESH_INTERVAL
     access_token = github_auth["access_token"]
 
     if access_token is None:
         return
 
-    github_auth["status"] = LoginStatus.LOGGING_IN
+    with _token_lock:
+        github_auth["status"] = LoginStatus.LOGGING_IN
     emit_github_login_status_change()
 
     try:
-        resp = requests.get(f'{GH_REST_API_BASE_URL}/copilot_internal/v2/token', headers={
-            'authorization': f'token {access_token}',
-            'editor-version': EDITOR_VERSION,
-            'editor-plugin-version': EDITOR_PLUGIN_VERSION,
-            'user-agent': USER_AGENT
+        resp = _SESSION.get(f'{GH_REST_API_BASE_URL}/copilot_internal/v2/token', headers={
+            **_TOKEN_HEADERS,
+            'authorization': f'token {access_token}'
         })
 
         resp_json = resp.json()
@@ -322,15 +446,16 @@ def get_token():
             return
 
         token = resp_json.get('token')
-        github_auth["token"] = token
         expires_at = resp_json.get('expires_at')
-        if expires_at is not None:
-            github_auth["token_expires_at"] = dt.datetime.fromtimestamp(expires_at)
-        else:
-            github_auth["token_expires_at"] = dt.datetime.now() + dt.timedelta(seconds=TOKEN_REFRESH_INTERVAL)
-        github_auth["verification_uri"] = None
-        github_auth["user_code"] = None
-        github_auth["status"] = LoginStatus.LOGGED_IN
+        with _token_lock:
+            github_auth["token"] = token
+            if expires_at is not None:
+                github_auth["token_expires_at"] = dt.datetime.fromtimestamp(expires_at)
+            else:
+                github_auth["token_expires_at"] = dt.datetime.now() + dt.timedelta(seconds=TOKEN_REFRESH_INTERVAL)
+            github_auth["verification_uri"] = None
+            github_auth["user_code"] = None
+            github_auth["status"] = LoginStatus.LOGGED_IN
         emit_github_login_status_change()
 
         endpoints = resp_json.get('endpoints', {})
@@ -340,71 +465,169 @@ def get_token():
     except Exception as e:
         log.error(f"Failed to get token from GitHub Copilot: {e}")
 
-def get_token_thread_func():
-    global github_auth, get_token_thread, last_token_fetch_time
+async def _token_lifecycle():
+    """
+    Wait for the user to authorize the device, then keep the Copilot token
+    fresh until logged out or stop requested. Runs as a single task on the
+    HTTP loop, blocking auth requests run in worker threads.
+    """
+    global github_auth, _token_lifecycle_future
+
+    if github_access_token_provided is not None:
+        log.info("Using existing GitHub access token")
+        github_auth["access_token"] = github_access_token_provided
+
+    try:
+        await _run_token_lifecycle()
+    except Exception as e:
+        log.error(f"GitHub token lifecycle failed: {e}")
+        with _token_lifecycle_lock:
+            _token_lifecycle_future = None
+
+async def _run_token_lifecycle():
+    global last_token_fetch_time, _token_lifecycle_future
+
     while True:
-        # terminate thread if logged out or stop requested
-        if stop_requested or github_auth["status"] == LoginStatus.NOT_LOGGED_IN:
-            get_token_thread = None
-            return
-        token = github_auth["token"]
-        # update token if 10 seconds or less left to expiration
-        if github_auth["access_token"] is not None and (token is None or (dt.datetime.now() - github_auth["token_expires_at"]).total_seconds() > -10):
-            if (dt.datetime.now() - last_token_fetch_time).total_seconds() > TOKEN_FETCH_INTERVAL:
-                log.info("Refreshing GitHub token")
-                get_token()
-                last_token_fetch_time = dt.datetime.now()
+        with _token_lifecycle_lock:
+            if stop_requested or github_auth["status"] == LoginStatus.NOT_LOGGED_IN:
+                _token_lifecycle_future = None
+                return
+
+        if github_auth["access_token"] is None:
+            if github_auth["device_code"] is not None:
+                await asyncio.to_thread(_poll_user_access_token)
+                if github_auth["access_token"] is None:
+                    await asyncio.sleep(github_auth["interval"])
+                    continue
+        else:
+            token = github_auth["token"]
+            # update token if 10 seconds or less left to expiration
+            if token is None or (dt.datetime.now() - github_auth["token_expires_at"]).total_seconds() > -10:
+                if (dt.datetime.now() - last_token_fetch_time).total_seconds() > TOKEN_FETCH_INTERVAL:
+                    log.info("Refreshing GitHub token")
+                    await asyncio.to_thread(get_token)
+                    last_token_fetch_time = dt.datetime.now()
 
-        time.sleep(TOKEN_THREAD_SLEEP_INTERVAL)
+        await asyncio.sleep(TOKEN_THREAD_SLEEP_INTERVAL)
 
 def wait_for_tokens():
-    global get_access_code_thread, get_token_thread
-    if get_access_code_thread is None:
-        get_access_code_thread = threading.Thread(target=wait_for_user_access_token_thread_func)
-        get_access_code_thread.start()
-
-    if get_token_thread is None:
-        get_token_thread = threading.Thread(target=get_token_thread_func)
-        get_token_thread.start()
+    global _token_lifecycle_future
+    with _token_lifecycle_lock:
+        if _token_lifecycle_future is None:
+            _token_lifecycle_future = _run_on_http_loop(_token_lifecycle())
+
+def _next_uuid() -> str:
+    with _uuid_pool_lock:
+        if not _uuid_pool:
+            # one urandom read for a batch of ids instead of one per uuid4 call
+            random_bytes = os.urandom(16 * UUID_POOL_SIZE)
+            _uuid_pool.extend(str(uuid.UUID(bytes=random_bytes[i:i + 16], version=4)) for i in range(0, len(random_bytes), 16))
+        return _uuid_pool.pop()
 
 def generate_copilot_headers():
     global github_auth
     token = github_auth['token']
 
-    return {
-        'authorization': f'Bearer {token}',
-        'editor-version': EDITOR_VERSION,
-        'editor-plugin-version': EDITOR_PLUGIN_VERSION,
-        'user-agent': USER_AGENT,
-        'content-type': 'application/json',
-        'openai-intent': 'conversation-panel',
-        'openai-organization': 'github-copilot',
-        'copilot-integration-id': 'vscode-chat',
-        'x-request-id': str(uuid.uuid4()),
-        'vscode-sessionid': str(uuid.uuid4()),
-        'vscode-machineid': MACHINE_ID,
-    }
+    headers = _COPILOT_STATIC_HEADERS.copy()
+    headers['authorization'] = f'Bearer {token}'
+    headers['x-request-id'] = _next_uuid()
+    headers['vscode-sessionid'] = _next_uuid()
+
+    return headers
+
+async def _iter_sse_data(resp: aiohttp.ClientResponse) -> AsyncIterator[bytearray]:
+    """
+    Yield the payload of each `data:` line of a server-sent event stream as
+    it arrives. Lines are located with bytearray.find over the buffered
+    chunks instead of decoding and splitting the whole body.
+    """
+    buffer = bytearray()
+    async for chunk, _ in resp.content.iter_chunks():
+        buffer += chunk
+        start = 0
+        while True:
+            end = buffer.find(b'\n', start)
+            if end == -1:
+                break
+            if buffer.startswith(b'data:', start, end):
+                yield _strip_sse_data_line(buffer, start, end)
+            start = end + 1
+        if start > 0:
+            del buffer[:start]
+
+    # last line may not be terminated
+    if buffer.startswith(b'data:'):
+        yield _strip_sse_data_line(buffer, 0, len(buffer))
+
+def _strip_sse_data_line(buffer: bytearray, start: int, end: int) -> bytearray:
+    if end > start and buffer[end - 1] == 0x0d: # \r
+        end -= 1
+    start += 5
+    if start < end and buffer[start] == 0x20: # optional space after data:
+        start += 1
+    return buffer[start:end]
+
+async def _iter_batches(items: AsyncIterator, max_size: int, interval: float) -> AsyncIterator[list]:
+    """
+    Group the items of an async iterator into lists. A list is yielded when
+    it has max_size items or when interval seconds passed since its first
+    item arrived, whichever comes first.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = aiter(items)
+    batch = []
+    deadline = None
+    next_item = None
+    try:
+        while True:
+            if next_item is None:
+                next_item = asyncio.ensure_future(anext(iterator))
+            timeout = max(0, deadline - loop.time()) if batch else None
+            done, _ = await asyncio.wait({next_item}, timeout=timeout)
+            if not done:
+                yield batch
+                batch = []
+                continue
 
-def inline_completions(model_id, prefix, suffix, language, filename, context: CompletionContext, cancel_token: CancelToken) -> str:
+            completed, next_item = next_item, None
+            try:
+                item = completed.result()
+            except StopAsyncIteration:
+                break
+            if not batch:
+                deadline = loop.time() + interval
+            batch.append(item)
+            if len(batch) >= max_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+    finally:
+        if next_item is not None:
+            next_item.cancel()
+
+async def _inline_completions(model_id, prefix, suffix, language, filename, context: CompletionContext, cancel_token: CancelToken) -> str:
     global github_auth
     token = github_auth['token']
 
-    prompt = f"# Path: {filename}"
-
     if cancel_token.is_cancel_requested:
         return ''
 
+    prompt_parts = [f"# Path: {filename}"]
     if context is not None:
         for item in context.items:
             context_file = f"Compare this snippet from {item.filePath if item.filePath is not None else 'undefined'}:{NL}{item.content}{NL}"
-            prompt += "\n# " + "\n# ".join(context_file.split('\n'))
+            prompt_parts.append("# " + context_file.replace(NL, f"{NL}# "))
+    prompt_parts.append(prefix)
+    prompt = NL.join(prompt_parts)
 
-    prompt += f"{NL}{prefix}"
+    result_parts = []
 
     try:
         if cancel_token.is_cancel_requested:
             return ''
-        resp = requests.post(f"{PROXY_ENDPOINT}/v1/engines/{model_id}/completions",
+        async with _get_http_session().post(f"{PROXY_ENDPOINT}/v1/engines/{model_id}/completions",
             headers={'authorization': f'Bearer {token}'},
                 json={
                 'prompt': prompt,
@@ -423,7 +646,15 @@ def inline_completions(model_id, prefix, suffix, language, filename, context: Co
                     'trim_by_indentation': True
                 }
             }
-        )
+        ) as resp:
+            async for payload in _iter_sse_data(resp):
+                if cancel_token.is_cancel_requested:
+                    return ''
+                if payload.startswith(b'{'):
+                    json_completion = json_loads(payload)
+                    completion = json_completion.get('choices')[0].get('text')
+                    if completion:
+                        result_parts.append(completion)
     except Exception as e:
         log.error(f"Failed to get inline completions: {e}")
         return ''
@@ -431,23 +662,15 @@ def inline_completions(model_id, prefix, suffix, language, filename, context: Co
     if cancel_token.is_cancel_requested:
         return ''
 
-    result = ''
+    return ''.join(result_parts)
 
-    decoded_response = resp.content.decode()
+async def async_inline_completions(model_id, prefix, suffix, language, filename, context: CompletionContext, cancel_token: CancelToken) -> str:
+    return await asyncio.wrap_future(_run_on_http_loop(_inline_completions(model_id, prefix, suffix, language, filename, context, cancel_token)))
 
-    resp_text = decoded_response.split('\n')
-    for line in resp_text:
-        if line.startswith('data: {'):
-            json_completion = json.loads(line[6:])
-            completion = json_completion.get('choices')[0].get('text')
-            if completion:
-                result += completion
-            # else:
-            #     result += '\n'
-    
-    return result
+def inline_completions(model_id, prefix, suffix, language, filename, context: CompletionContext, cancel_token: CancelToken) -> str:
+    return _run_on_http_loop(_inline_completions(model_id, prefix, suffix, language, filename, context, cancel_token)).result()
 
-def _aggregate_streaming_response(client: sseclient.SSEClient) -> dict:
+async def _aggregate_streaming_response(resp: aiohttp.ClientResponse) -> dict:
     final_tool_calls = []
     final_content = ''
 
@@ -468,11 +691,11 @@ def _aggregate_streaming_response(client: sseclient.SSEClient) -> dict:
             ]
         }
 
-    for event in client.events():
-        if event.data == '[DONE]':
+    async for payload in _iter_sse_data(resp):
+        if payload == b'[DONE]':
             return _format_llm_response()
 
-        chunk = json.loads(event.data)
+        chunk = json_loads(payload)
         if len(chunk['choices']) == 0:
             continue
 
@@ -497,7 +720,7 @@ def _aggregate_streaming_response(client: sseclient.SSEClient) -> dict:
 
     return _format_llm_response()
 
-def completions(model_id, messages, tools = None, response: ChatResponse = None, cancel_token: CancelToken = None, options: dict = {}) -> Any:
+async def _completions(model_id, messages, tools = None, response: ChatResponse = None, cancel_token: CancelToken = None, options: dict = {}) -> Any:
     aggregate = response is None
 
     try:
@@ -523,35 +746,58 @@ def completions(model_id, messages, tools = None, response: ChatResponse = None,
                 response.finish()
             return
 
-        request = requests.post(
+        # only deterministic, non-streamed responses are cached
+        cache_key = None
+        if aggregate and data['temperature'] == 0:
+            cache_key = _prompt_cache_key(options.get('cache_namespace', ''), data)
+            cached_response = _get_cached_response(cache_key)
+            if cached_response is not None:
+                return cached_response
+
+        async with _get_http_session().post(
             f"{API_ENDPOINT}/chat/completions",
             headers = generate_copilot_headers(),
-            json = data,
-            stream = True
-        )
-
-        if request.status_code != 200:
-            msg = f"Failed to get completions from GitHub Copilot: [{request.status_code}]: {request.text}"
-            log.error(msg)
-            if response is not None:
-                response.stream(MarkdownData(msg))
-                response.finish()
-            raise Exception(msg)
-
-        client = sseclient.SSEClient(request)
-        if aggregate:
-            return _aggregate_streaming_response(client)
-        else:
-            for event in client.events():
-                if cancel_token is not None and cancel_token.is_cancel_requested:
-                    response.finish()
-                if event.data == '[DONE]':
+            json = data
+        ) as request:
+            if request.status != 200:
+                msg = f"Failed to get completions from GitHub Copilot: [{request.status}]: {await request.text()}"
+                log.error(msg)
+                if response is not None:
+                    response.stream(MarkdownData(msg))
                     response.finish()
-                else:
-                    response.stream(json.loads(event.data))
+                raise Exception(msg)
+
+            if aggregate:
+                aggregated_response = await _aggregate_streaming_response(request)
+                if cache_key is not None:
+                    _cache_response(cache_key, aggregated_response)
+                return aggregated_response
+            else:
+                # coalesce stream chunks to reduce the number of frontend updates
+                async for payloads in _iter_batches(_iter_sse_data(request), STREAM_BATCH_MAX_SIZE, STREAM_BATCH_INTERVAL):
+                    if cancel_token is not None and cancel_token.is_cancel_requested:
+                        response.finish()
+                        return
+                    batch = []
+                    for payload in payloads:
+                        if payload == b'[DONE]':
+                            if batch:
+                                response.stream_batch(batch)
+                                batch = []
+                            response.finish()
+                        else:
+                            batch.append(json_loads(payload))
+                    if batch:
+                        response.stream_batch(batch)
         return
-    except requests.exceptions.ConnectionError:
+    except aiohttp.ClientConnectionError:
         raise Exception("Connection error")
     except Exception as e:
         log.error(f"Failed to get completions from GitHub Copilot: {e}")
         raise e
+
+async def async_completions(model_id, messages, tools = None, response: ChatResponse = None, cancel_token: CancelToken = None, options: dict = {}) -> Any:
+    return await asyncio.wrap_future(_run_on_http_loop(_completions(model_id, messages, tools, response, cancel_token, options)))
+
+def completions(model_id, messages, tools = None, response: ChatResponse = None, cancel_token: CancelToken = None, options: dict = {}) -> Any:
+    return _run_on_http_loop(_completions(model_id, messages, tools, response, cancel_token, options)).result()
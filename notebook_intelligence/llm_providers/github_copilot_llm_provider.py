@@ -4,7 +4,7 @@ from typing import Any
 
 import requests
 from notebook_intelligence.api import ChatModel, EmbeddingModel, InlineCompletionModel, LLMProvider, CancelToken, ChatResponse, CompletionContext
-from notebook_intelligence.github_copilot import generate_copilot_headers, completions, inline_completions
+from notebook_intelligence.github_copilot import generate_copilot_headers, completions, async_completions, inline_completions, async_inline_completions
 import logging
 
 log = logging.getLogger(__name__)
@@ -38,6 +38,9 @@ class GitHubCopilotChatModel(ChatModel):
     def completions(self, messages: list[dict], tools: list[dict] = None, response: ChatResponse = None, cancel_token: CancelToken = None, options: dict = {}) -> Any:
         return completions(self._model_id, messages, tools, response, cancel_token, options)
 
+    async def acompletions(self, messages: list[dict], tools: list[dict] = None, response: ChatResponse = None, cancel_token: CancelToken = None, options: dict = {}) -> Any:
+        return await async_completions(self._model_id, messages, tools, response, cancel_token, options)
+
 class GitHubCopilotInlineCompletionModel(InlineCompletionModel):
     def __init__(self, provider: LLMProvider, model_id: str, model_name: str):
         super().__init__(provider)
@@ -59,6 +62,9 @@ class GitHubCopilotInlineCompletionModel(InlineCompletionModel):
     def inline_completions(self, prefix, suffix, language, filename, context: CompletionContext, cancel_token: CancelToken) -> str:
         return inline_completions(self._model_id, prefix, suffix, language, filename, context, cancel_token)
 
+    async def ainline_completions(self, prefix, suffix, language, filename, context: CompletionContext, cancel_token: CancelToken) -> str:
+        return await async_inline_completions(self._model_id, prefix, suffix, language, filename, context, cancel_token)
+
 class GitHubCopilotLLMProvider(LLMProvider):
     def __init__(self):
         self._chat_models = [
@@ -1,21 +1,42 @@
 # Copyright (c) Mehmet Bektas <mbektasgh@outlook.com>
 
-import json
-from typing import Any
-from notebook_intelligence.api import ChatModel, EmbeddingModel, InlineCompletionModel, LLMProvider, CancelToken, ChatResponse, CompletionContext
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Union
+from notebook_intelligence.api import ChatModel, EmbeddingModel, InlineCompletionModel, LLMProvider, CancelToken, ChatResponse, CompletionContext, Signal, SignalImpl
 import ollama
 import logging
+import threading
 
 from notebook_intelligence.util import extract_llm_generated_code
 
 log = logging.getLogger(__name__)
 
-OLLAMA_EMBEDDING_FAMILIES = set(["nomic-bert", "bert"])
-QWEN_INLINE_COMPL_PROMPT = """<|fim_prefix|>{prefix}<|fim_suffix|>{suffix}<|fim_middle|>"""
-DEEPSEEK_INLINE_COMPL_PROMPT = """<｜fim▁begin｜>{prefix}<｜fim▁hole｜>{suffix}<｜fim▁end｜>"""
-CODELLAMA_INLINE_COMPL_PROMPT = """<PRE> {prefix} <SUF>{suffix} <MID>"""
-STARCODER_INLINE_COMPL_PROMPT = """<fim_prefix>{prefix}<fim_suffix>{suffix}<fim_middle>"""
-CODESTRAL_INLINE_COMPL_PROMPT = """[SUFFIX]{suffix}[PREFIX]{prefix}"""
+MODEL_INFO_MAX_WORKERS = 8
+OLLAMA_EMBEDDING_FAMILIES = frozenset({"nomic-bert", "bert"})
+
+@dataclass(frozen=True)
+class FIMPromptTemplate:
+    # prompt is start + prefix + middle + suffix + end, prefix and suffix are swapped if suffix_first
+    start: str
+    middle: str
+    end: str
+    suffix_first: bool = False
+
+    def format(self, prefix: str, suffix: str) -> str:
+        if self.suffix_first:
+            return f"{self.start}{suffix}{self.middle}{prefix}{self.end}"
+        return f"{self.start}{prefix}{self.middle}{suffix}{self.end}"
+
+QWEN_INLINE_COMPL_PROMPT = FIMPromptTemplate("<|fim_prefix|>", "<|fim_suffix|>", "<|fim_middle|>")
+DEEPSEEK_INLINE_COMPL_PROMPT = FIMPromptTemplate("<｜fim▁begin｜>", "<｜fim▁hole｜>", "<｜fim▁end｜>")
+CODELLAMA_INLINE_COMPL_PROMPT = FIMPromptTemplate("<PRE> ", " <SUF>", " <MID>")
+STARCODER_INLINE_COMPL_PROMPT = FIMPromptTemplate("<fim_prefix>", "<fim_suffix>", "<fim_middle>")
+CODESTRAL_INLINE_COMPL_PROMPT = FIMPromptTemplate("[SUFFIX]", "[PREFIX]", "", suffix_first=True)
+
+# (model name, digest) -> context window, model info doesn't change for a digest
+_context_window_cache: dict[tuple[str, str], int] = {}
 
 class OllamaChatModel(ChatModel):
     def __init__(self, provider: LLMProvider, model_id: str, model_name: str, context_window: int):
@@ -36,44 +57,67 @@ class OllamaChatModel(ChatModel):
     def context_window(self) -> int:
         return self._context_window
 
-    def completions(self, messages: list[dict], tools: list[dict] = None, response: ChatResponse = None, cancel_token: CancelToken = None, options: dict = {}) -> Any:
-        stream = response is not None
+    def _completion_args(self, messages: list[dict], tools: list[dict], stream: bool) -> dict:
         completion_args = {
             "model": self._model_id, 
-            "messages": messages.copy(),
+            "messages": messages,
             "stream": stream,
         }
         if tools is not None and len(tools) > 0:
             completion_args["tools"] = tools
+        return completion_args
+
+    @staticmethod
+    def _stream_frame() -> tuple[dict, dict]:
+        # one frame per stream, the delta is updated in place for each chunk
+        delta = {"role": None, "content": None}
+        return {"choices": [{"delta": delta}]}, delta
+
+    @staticmethod
+    def _completion_result(ollama_response) -> dict:
+        return {
+            'choices': [
+                {
+                    'message': ollama_response.message.model_dump(mode='json')
+                }
+            ]
+        }
 
-        ollama_response = ollama.chat(**completion_args)
+    def completions(self, messages: list[dict], tools: list[dict] = None, response: ChatResponse = None, cancel_token: CancelToken = None, options: dict = {}) -> Any:
+        stream = response is not None
+        ollama_response = self._provider.client.chat(**self._completion_args(messages, tools, stream))
 
         if stream:
+            frame, delta = OllamaChatModel._stream_frame()
             for chunk in ollama_response:
-                response.stream({
-                        "choices": [{
-                            "delta": {
-                                "role": chunk['message']['role'],
-                                "content": chunk['message']['content']
-                            }
-                        }]
-                    })
+                delta["role"] = chunk['message']['role']
+                delta["content"] = chunk['message']['content']
+                response.stream(frame)
             response.finish()
             return
         else:
-            json_resp = json.loads(ollama_response.model_dump_json())
+            return OllamaChatModel._completion_result(ollama_response)
 
-            return {
-                'choices': [
-                    {
-                        'message': json_resp['message']
-                    }
-                ]
-            }
+    async def acompletions(self, messages: list[dict], tools: list[dict] = None, response: ChatResponse = None, cancel_token: CancelToken = None, options: dict = {}) -> Any:
+        stream = response is not None
+        ollama_response = await self._provider.get_async_client().chat(**self._completion_args(messages, tools, stream))
+
+        if stream:
+            frame, delta = OllamaChatModel._stream_frame()
+            async for chunk in ollama_response:
+                if cancel_token is not None and cancel_token.is_cancel_requested:
+                    break
+                delta["role"] = chunk['message']['role']
+                delta["content"] = chunk['message']['content']
+                response.stream(frame)
+            response.finish()
+            return
+        else:
+            return OllamaChatModel._completion_result(ollama_response)
 
 
 class OllamaInlineCompletionModel(InlineCompletionModel):
-    def __init__(self, provider: LLMProvider, model_id: str, model_name: str, context_window: int, prompt_template: str):
+    def __init__(self, provider: LLMProvider, model_id: str, model_name: str, context_window: int, prompt_template: FIMPromptTemplate):
         super().__init__(provider)
         self._model_id = model_id
         self._model_name = model_name
@@ -92,38 +136,44 @@ class OllamaInlineCompletionModel(InlineCompletionModel):
     def context_window(self) -> int:
         return self._context_window
 
-    def inline_completions(self, prefix, suffix, language, filename, context: CompletionContext, cancel_token: CancelToken) -> str:
-        has_suffix = suffix.strip() != ""
-        if has_suffix:
-            prompt = self._prompt_template.format(prefix=prefix, suffix=suffix.strip())
+    def _generate_args(self, prefix: str, suffix: str) -> dict:
+        suffix = suffix.strip()
+        if suffix != "":
+            prompt = self._prompt_template.format(prefix=prefix, suffix=suffix)
         else:
             prompt = prefix
 
+        return {
+            "model": self._model_id, 
+            "prompt": prompt,
+            "raw": True,
+            "options": {
+                'num_predict': 128,
+                "temperature": 0,
+                "stop" : [
+                    "<|end▁of▁sentence|>",
+                    "<｜end▁of▁sentence｜>",
+                    "<|EOT|>",
+                    "<EOT>",
+                    "\\n",
+                    "</s>",
+                    "<|eot_id|>",
+                ],
+            },
+        }
+
+    def inline_completions(self, prefix, suffix, language, filename, context: CompletionContext, cancel_token: CancelToken) -> str:
+        try:
+            ollama_response = self._provider.client.generate(**self._generate_args(prefix, suffix))
+            return extract_llm_generated_code(ollama_response.response)
+        except Exception as e:
+            log.error(f"Error occurred while generating using completions ollama: {e}")
+            return ""
+
+    async def ainline_completions(self, prefix, suffix, language, filename, context: CompletionContext, cancel_token: CancelToken) -> str:
         try:
-            generate_args = {
-                "model": self._model_id, 
-                "prompt": prompt,
-                "raw": True,
-                "options": {
-                    'num_predict': 128,
-                    "temperature": 0,
-                    "stop" : [
-                        "<|end▁of▁sentence|>",
-                        "<｜end▁of▁sentence｜>",
-                        "<|EOT|>",
-                        "<EOT>",
-                        "\\n",
-                        "</s>",
-                        "<|eot_id|>",
-                    ],
-                },
-            }
-
-            ollama_response = ollama.generate(**generate_args)
-            code = ollama_response.response
-            code = extract_llm_generated_code(code)
-
-            return code
+            ollama_response = await self._provider.get_async_client().generate(**self._generate_args(prefix, suffix))
+            return extract_llm_generated_code(ollama_response.response)
         except Exception as e:
             log.error(f"Error occurred while generating using completions ollama: {e}")
             return ""
@@ -132,7 +182,15 @@ class OllamaLLMProvider(LLMProvider):
     def __init__(self):
         super().__init__()
         self._chat_models = []
-        self.update_chat_model_list()
+        # one client for all sync calls so its connection pool is reused
+        self._client = ollama.Client()
+        # (event loop, client), the async client's connections belong to the loop it is used on
+        self._async_client: tuple[asyncio.AbstractEventLoop, ollama.AsyncClient] = None
+        self._chat_models_updated_signal = SignalImpl()
+        # the first model list refresh runs in the background so that server startup
+        # and capability requests never wait on Ollama, chat_models is empty until it is done
+        self._initial_update_thread = threading.Thread(target=self.update_chat_model_list, name="nbi-ollama-models", daemon=True)
+        self._initial_update_thread.start()
 
     @property
     def id(self) -> str:
@@ -146,6 +204,10 @@ class OllamaLLMProvider(LLMProvider):
     def chat_models(self) -> list[ChatModel]:
         return self._chat_models
 
+    @property
+    def chat_models_updated_signal(self) -> Signal:
+        return self._chat_models_updated_signal
+
     @property
     def inline_completion_models(self) -> list[InlineCompletionModel]:
         return [
@@ -159,24 +221,46 @@ class OllamaLLMProvider(LLMProvider):
     @property
     def embedding_models(self) -> list[EmbeddingModel]:
         return []
+
+    @property
+    def client(self) -> ollama.Client:
+        return self._client
+
+    def get_async_client(self) -> ollama.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_client[0] is not loop:
+            self._async_client = (loop, ollama.AsyncClient())
+        return self._async_client[1]
     
+    def _fetch_model_info(self, model) -> Union[OllamaChatModel, None]:
+        try:
+            model_family = model.details.family
+            if model_family in OLLAMA_EMBEDDING_FAMILIES:
+                return None
+            cache_key = (model.model, model.digest)
+            context_window = _context_window_cache.get(cache_key)
+            if context_window is None:
+                model_show = self._client.show(model.model)
+                model_info = model_show.modelinfo or {}
+                context_length_key = f"{model_family}.context_length"
+                context_window = model_info.get(context_length_key)
+                if context_window is None:
+                    log.warning(f"Ollama model {model.model} has no {context_length_key} in model info, skipping it")
+                    return None
+                _context_window_cache[cache_key] = context_window
+            return OllamaChatModel(self, model.model, model.model, context_window)
+        except Exception as e:
+            log.error(f"Error getting Ollama model info {model}: {e}")
+            return None
+
     def update_chat_model_list(self):
         try:
-            response = ollama.list()
+            response = self._client.list()
             models = response.models
-            self._chat_models = []
-            for model in models:
-                try:
-                    model_family = model.details.family
-                    if model_family in OLLAMA_EMBEDDING_FAMILIES:
-                        continue
-                    model_show = ollama.show(model.model)
-                    model_info = model_show.modelinfo
-                    context_window = model_info[f"{model_family}.context_length"]
-                    self._chat_models.append(
-                        OllamaChatModel(self, model.model, model.model, context_window)
-                    )
-                except Exception as e:
-                    log.error(f"Error getting Ollama model info {model}: {e}")
+            # model info requests are independent, issue them concurrently
+            with ThreadPoolExecutor(max_workers=MODEL_INFO_MAX_WORKERS) as executor:
+                chat_models = list(executor.map(self._fetch_model_info, models))
+            self._chat_models = [model for model in chat_models if model is not None]
+            self._chat_models_updated_signal.emit()
         except Exception as e:          
             log.error(f"Error updating supported Ollama models: {e}")
@@ -86,7 +86,8 @@ class MCPTool(Tool):
                 call_args[key] = tool_args.get(key)
 
         try:
-            result = self._server.call_tool(self.name, call_args)
+            # call_tool blocks until the MCP client thread responds
+            result = await asyncio.to_thread(self._server.call_tool, self.name, call_args)
             if hasattr(result, "content") and isinstance(result.content, list):
                 if len(result.content) > 0:
                     text_contents = []
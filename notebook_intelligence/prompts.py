@@ -1,6 +1,8 @@
 # Copyright (c) Mehmet Bektas <mbektasgh@outlook.com>
 # Some prompts modified from GitHub Copilot's system prompts. Copyright (c) GitHub
 
+import functools
+
 IDE_NAME = "JupyterLab"
 OS_TYPE = "Linux"
 
@@ -39,10 +41,13 @@ You can only give one reply for each conversation turn.
 """
 
 class Prompts:
+    # prompts only depend on the model, so each is formatted once
     @staticmethod
+    @functools.cache
     def generic_chat_prompt(model_provider: str, model_name: str) -> str:
         return CHAT_SYSTEM_PROMPT.format(AI_ASSISTANT_NAME="Notebook Intelligence", IDE_NAME=IDE_NAME, OS_TYPE=OS_TYPE, MODEL_NAME=model_name, MODEL_PROVIDER=model_provider)
 
     @staticmethod
+    @functools.cache
     def github_copilot_chat_prompt(model_provider: str, model_name: str) -> str:
         return CHAT_SYSTEM_PROMPT.format(AI_ASSISTANT_NAME="GitHub Copilot", IDE_NAME=IDE_NAME, OS_TYPE=OS_TYPE, MODEL_NAME=model_name, MODEL_PROVIDER=model_provider)
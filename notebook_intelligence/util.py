@@ -2,38 +2,71 @@
 
 import os
 import base64
+import re
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.fernet import Fernet
 import asyncio
+from typing import Any, Callable, Union
 from tornado import ioloop
 
+import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _stdlib_json_loads(data: Union[str, bytes, bytearray]) -> Any:
+    return json.loads(data)
+
+def _stdlib_json_dumps(obj: Any, sort_keys: bool = False, default: Callable = None) -> str:
+    return json.dumps(obj, sort_keys=sort_keys, default=default, separators=(',', ':'))
+
+def _stdlib_json_dumps_bytes(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _orjson_loads(data: Union[str, bytes, bytearray]) -> Any:
+    return orjson.loads(data)
+
+def _orjson_dumps(obj: Any, sort_keys: bool = False, default: Callable = None) -> str:
+    # non-str keys are coerced to str, same as the stdlib json module
+    option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return orjson.dumps(obj, default=default, option=option).decode('utf-8')
+
+def _orjson_dumps_bytes(obj: Any) -> bytes:
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+# faster JSON encoding and decoding when orjson is installed, stdlib json otherwise
+json_loads = _orjson_loads if orjson is not None else _stdlib_json_loads
+json_dumps = _orjson_dumps if orjson is not None else _stdlib_json_dumps
+# UTF-8 encoded JSON, orjson encodes to bytes without an intermediate str
+json_dumps_bytes = _orjson_dumps_bytes if orjson is not None else _stdlib_json_dumps_bytes
+
+# a line starting with a code fence, after leading whitespace
+_CODE_FENCE_LINE_RE = re.compile(r'^[^\S\n]*```', re.MULTILINE)
+
 def extract_llm_generated_code(code: str) -> str:
         if code.endswith("```"):
             code = code[:-3]
 
-        lines = code.split("\n")
-        if len(lines) < 2:
+        if "\n" not in code:
             return code
 
-        num_lines = len(lines)
-        start_line = -1
-        end_line = num_lines
+        # return the lines between the first fence line and the next one
+        start_fence = _CODE_FENCE_LINE_RE.search(code)
+        if start_fence is None:
+            return code
 
-        for i in range(num_lines):
-            if start_line == -1:
-                if lines[i].lstrip().startswith("```"):
-                    start_line = i
-                    continue
-            else:
-                if lines[i].lstrip().startswith("```"):
-                    end_line = i
-                    break
+        start = code.find("\n", start_fence.end())
+        if start == -1:
+            return ""
+        start += 1
 
-        if start_line != -1:
-            lines = lines[start_line+1:end_line]
+        end_fence = _CODE_FENCE_LINE_RE.search(code, start)
+        if end_fence is None:
+            return code[start:]
 
-        return "\n".join(lines)
+        return code[start:end_fence.start() - 1]
 
 def encrypt_with_password(password: str, data: bytes) -> bytes:
     salt = os.urandom(16)
@@ -94,6 +94,7 @@ export class NBIAPI {
   };
   static _webSocket: WebSocket;
   static _messageReceived = new Signal<unknown, any>(this);
+  static _textDecoder = new TextDecoder();
   static config = new NBIConfig();
   static configChanged = this.config.changed;
   static githubLoginStatusChanged = new Signal<unknown, void>(this);
@@ -105,7 +106,6 @@ export class NBIAPI {
     NBIAPI.initializeWebsocket();
 
     this._messageReceived.connect((_, msg) => {
-      msg = JSON.parse(msg);
       if (msg.type === BackendMessageType.MCPServerStatusChange) {
         this.fetchCapabilities();
       } else if (
@@ -127,8 +127,22 @@ export class NBIAPI {
     );
 
     this._webSocket = new serverSettings.WebSocket(wsUrl);
+    // chat responses are sent as UTF-8 JSON in binary frames
+    this._webSocket.binaryType = 'arraybuffer';
     this._webSocket.onmessage = msg => {
-      this._messageReceived.emit(msg.data);
+      const data = JSON.parse(
+        msg.data instanceof ArrayBuffer
+          ? this._textDecoder.decode(msg.data)
+          : msg.data
+      );
+      // stream messages can be sent in batches
+      if (Array.isArray(data.batch)) {
+        for (const item of data.batch) {
+          this._messageReceived.emit(item);
+        }
+      } else {
+        this._messageReceived.emit(data);
+      }
     };
 
     this._webSocket.onerror = msg => {
@@ -304,7 +318,6 @@ export class NBIAPI {
     responseEmitter: IChatCompletionResponseEmitter
   ) {
     this._messageReceived.connect((_, msg) => {
-      msg = JSON.parse(msg);
       if (msg.id === messageId) {
         responseEmitter.emit(msg);
       }
@@ -352,7 +365,6 @@ export class NBIAPI {
   ) {
     const messageId = UUID.uuid4();
     this._messageReceived.connect((_, msg) => {
-      msg = JSON.parse(msg);
       if (msg.id === messageId) {
         responseEmitter.emit(msg);
       }
@@ -404,7 +416,6 @@ export class NBIAPI {
     responseEmitter: IChatCompletionResponseEmitter
   ) {
     this._messageReceived.connect((_, msg) => {
-      msg = JSON.parse(msg);
       if (msg.id === messageId) {
         responseEmitter.emit(msg);
       }
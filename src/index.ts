@@ -421,8 +421,10 @@ class NBIInlineCompletionProvider
         ActiveDocumentWatcher.activeDocumentInfo.filename,
         {
           emit: (response: any) => {
+            // completions are sent with the end of stream message
             if (
-              response.type === BackendMessageType.StreamMessage &&
+              response.type === BackendMessageType.StreamEnd &&
+              response.data?.completions !== undefined &&
               response.id === this._lastRequestInfo.messageId
             ) {
               items.push({
@@ -0,0 +1,134 @@
+import pytest
+
+from notebook_intelligence.ai_service_manager import AIServiceManager, DEFAULT_CHAT_PARTICIPANT_ID
+
+
+class TestParsePrompt:
+    @pytest.mark.parametrize("prompt,expected", [
+        ("hello world", [DEFAULT_CHAT_PARTICIPANT_ID, '', 'hello world']),
+        ("  @mcp /clear  ", ['mcp', 'clear', '']),
+        ("@mcp", ['mcp', '', '']),
+        ("/newNotebook plot data", [DEFAULT_CHAT_PARTICIPANT_ID, 'newNotebook', 'plot data']),
+        ("@mcp /run list files", ['mcp', 'run', 'list files']),
+        ("@mcp what is /tmp", ['mcp', '', 'what is /tmp']),
+        ("", [DEFAULT_CHAT_PARTICIPANT_ID, '', '']),
+    ])
+    def test_parse(self, prompt, expected):
+        assert AIServiceManager.parse_prompt(prompt) == expected
+
+    def test_input_whitespace_is_preserved(self):
+        prompt = "/fix\ndef f():\n    return  1\n"
+
+        assert AIServiceManager.parse_prompt(prompt) == [DEFAULT_CHAT_PARTICIPANT_ID, 'fix', 'def f():\n    return  1']
+
+
+class TestGetCompletionContext:
+    def test_runs_providers_concurrently_in_order(self):
+        import asyncio
+        import time
+        from types import SimpleNamespace
+        from notebook_intelligence.api import CancelToken, CompletionContext, CompletionContextProvider, ContextRequest, ContextRequestType
+
+        class _Provider(CompletionContextProvider):
+            def __init__(self, id, delay):
+                self._id = id
+                self._delay = delay
+
+            @property
+            def id(self):
+                return self._id
+
+            def handle_completion_context_request(self, request):
+                time.sleep(self._delay)
+                if self._id == 'failing':
+                    raise Exception('failed')
+                return CompletionContext([self._id])
+
+        providers = [_Provider('slow', 0.3), _Provider('fast', 0.05), _Provider('failing', 0.0), _Provider('slow2', 0.3), _Provider('other', 0.0)]
+        manager = SimpleNamespace(completion_context_providers={provider.id: provider for provider in providers})
+        participant = SimpleNamespace(allowed_context_providers=['slow', 'fast', 'failing', 'slow2'])
+        request = ContextRequest(ContextRequestType.InlineCompletion, '', '', 'python', 'test.py', participant=participant, cancel_token=CancelToken())
+
+        start = time.monotonic()
+        context = asyncio.run(AIServiceManager.get_completion_context(manager, request))
+
+        assert context.items == ['slow', 'fast', 'slow2']
+        assert time.monotonic() - start < 0.5
+
+
+class TestChatParticipantCapabilities:
+    def test_cached_until_participant_registered(self):
+        from types import SimpleNamespace
+
+        def _participant(id):
+            return SimpleNamespace(id=id, name=id.title(), description='', icon_path=None, commands=[SimpleNamespace(name='run')])
+
+        manager = AIServiceManager.__new__(AIServiceManager)
+        manager.chat_participants = {}
+        manager._chat_participant_capabilities = None
+        manager.register_chat_participant(_participant('first'))
+
+        capabilities = manager.chat_participant_capabilities
+        assert capabilities == [{"id": "first", "name": "First", "description": "", "iconPath": None, "commands": ["run"]}]
+        assert manager.chat_participant_capabilities is capabilities
+
+        manager.register_chat_participant(_participant('second'))
+        assert [participant["id"] for participant in manager.chat_participant_capabilities] == ["first", "second"]
+
+
+class TestModelIdCache:
+    def test_list_built_during_invalidation_is_not_kept(self):
+        from types import SimpleNamespace
+
+        manager = AIServiceManager.__new__(AIServiceManager)
+        manager._model_id_cache = {}
+        refreshed = []
+
+        class _Provider:
+            id = "ollama"
+
+            @property
+            def chat_models(self):
+                if not refreshed:
+                    # a background model refresh finishes while the list is built
+                    refreshed.append(True)
+                    manager.invalidate_model_id_cache()
+                    return []
+                return [SimpleNamespace(id="llama3", name="llama3", context_window=8192, properties=[])]
+
+        manager.llm_providers = {"ollama": _Provider()}
+
+        assert manager.chat_model_ids == []
+        model_ids = manager.chat_model_ids
+        assert [model["id"] for model in model_ids] == ["llama3"]
+        assert manager.chat_model_ids is model_ids
+
+
+class TestChatRequestDispatch:
+    def test_extension_participants_run_off_the_event_loop(self):
+        import asyncio
+        import threading
+        from types import SimpleNamespace
+        from unittest.mock import MagicMock
+        from notebook_intelligence.api import ChatRequest
+
+        threads = {}
+
+        def _participant(id):
+            async def handle_chat_request(request, response, options={}):
+                threads[id] = threading.current_thread()
+            return SimpleNamespace(id=id, handle_chat_request=handle_chat_request)
+
+        manager = AIServiceManager.__new__(AIServiceManager)
+        manager._chat_model = MagicMock()
+        manager.chat_participants = {"default": _participant("default"), "ext": _participant("ext")}
+        manager._extension_chat_participant_ids = {"ext"}
+
+        async def _dispatch():
+            await manager.handle_chat_request(ChatRequest(prompt="@ext hi"), MagicMock())
+            await manager.handle_chat_request(ChatRequest(prompt="hi"), MagicMock())
+
+        asyncio.run(_dispatch())
+
+        assert threads["default"] is threading.current_thread()
+        assert threads["ext"] is not threading.current_thread()
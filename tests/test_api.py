@@ -0,0 +1,27 @@
+import threading
+
+from notebook_intelligence.api import CancelTokenImpl
+
+
+class TestCancelTokenImpl:
+    def test_cancel_request(self):
+        cancel_token = CancelTokenImpl()
+        cancelled = []
+        cancel_token.cancellation_signal.connect(lambda: cancelled.append(True))
+
+        assert not cancel_token.is_cancel_requested
+        assert not cancel_token.wait(0)
+
+        cancel_token.cancel_request()
+
+        assert cancel_token.is_cancel_requested
+        assert cancel_token.wait(0)
+        assert cancelled == [True]
+
+    def test_wait_wakes_up_on_cancel(self):
+        cancel_token = CancelTokenImpl()
+        timer = threading.Timer(0.05, cancel_token.cancel_request)
+        timer.start()
+
+        assert cancel_token.wait(5)
+        timer.join()
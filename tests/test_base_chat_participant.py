@@ -0,0 +1,98 @@
+import pytest
+
+from notebook_intelligence.base_chat_participant import (
+    AddCodeCellTool,
+    AddMarkdownCellToNotebookTool,
+    BaseChatParticipant,
+    CreateNewNotebookTool,
+    FencedCodeCollector,
+    PythonTool,
+    SecuredExtensionTool,
+)
+from notebook_intelligence.api import ChatMode, ChatRequest
+from notebook_intelligence.util import extract_llm_generated_code
+
+
+def _collect(text, chunk_size):
+    collector = FencedCodeCollector()
+    for i in range(0, len(text), chunk_size):
+        if collector.cancel_token.is_cancel_requested:
+            break
+        collector.stream({"choices": [{"delta": {"content": text[i:i + chunk_size]}}]})
+    return collector
+
+
+class TestFencedCodeCollector:
+    @pytest.mark.parametrize("text", [
+        "print('hello')",
+        "import os\nprint(os.getcwd())\n",
+        "```python\nx = 1\n```",
+        "Here you go:\n```python\nx = 1\ny = 2\n```\nThis sets x and y.\n```\nmore\n```",
+        "```python\nx = 1\n",
+    ])
+    @pytest.mark.parametrize("chunk_size", [1, 3, 1000])
+    def test_matches_extract_llm_generated_code(self, text, chunk_size):
+        collector = _collect(text, chunk_size)
+
+        assert extract_llm_generated_code(collector.content) == extract_llm_generated_code(text)
+
+    def test_cancels_after_code_block(self):
+        cancelled = []
+        collector = FencedCodeCollector()
+        collector.cancel_token.cancellation_signal.connect(lambda: cancelled.append(True))
+        text = "```python\nx = 1\n```\nExplanation that is not needed"
+        for i in range(0, len(text), 4):
+            if collector.cancel_token.is_cancel_requested:
+                break
+            collector.stream({"choices": [{"delta": {"content": text[i:i + 4]}}]})
+
+        assert collector.cancel_token.is_cancel_requested
+        assert cancelled == [True]
+        assert collector.content == "```python\nx = 1\n```\n"
+
+
+class TestBuiltinToolSchemas:
+    @pytest.mark.parametrize("tool_class", [
+        CreateNewNotebookTool,
+        AddMarkdownCellToNotebookTool,
+        AddCodeCellTool,
+        PythonTool,
+    ])
+    def test_schema_matches_tool(self, tool_class):
+        tool = tool_class()
+
+        assert tool.schema["function"]["name"] == tool.name
+        assert tool.schema["function"]["description"] == tool.description
+        assert tool.schema is tool_class().schema
+        assert tool.tags == ["default-participant-tool"]
+
+
+class TestBaseChatParticipantTools:
+    def test_tools_are_built_once_per_request(self):
+        participant = BaseChatParticipant()
+        participant._current_chat_request = ChatRequest(chat_mode=ChatMode("ask", "Ask"))
+        tools = participant.tools
+
+        assert [tool.name for tool in tools] == ["add_markdown_cell_to_notebook", "add_code_cell_to_notebook", "python"]
+        assert participant.tools is tools
+
+        participant._current_chat_request = ChatRequest(chat_mode=ChatMode("ask", "Ask"))
+        assert participant.tools is not tools
+
+
+class TestSecuredExtensionTool:
+    def test_extension_tool_runs_off_the_event_loop(self):
+        import asyncio
+        import threading
+        from types import SimpleNamespace
+
+        threads = []
+
+        async def handle_tool_call(request, response, tool_context, tool_args):
+            threads.append(threading.current_thread())
+            return "done"
+
+        tool = SecuredExtensionTool(SimpleNamespace(handle_tool_call=handle_tool_call))
+
+        assert asyncio.run(tool.handle_tool_call(None, None, {}, {})) == "done"
+        assert threads[0] is not threading.current_thread()
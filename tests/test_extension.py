@@ -0,0 +1,404 @@
+import json
+from unittest.mock import MagicMock
+
+from notebook_intelligence.api import BackendMessageType, MarkdownData
+from notebook_intelligence.extension import ChatHistory, WebsocketCopilotResponseEmitter
+
+
+def _emitter():
+    websocket_handler = MagicMock()
+    websocket_handler.is_closed = False
+    # run scheduled writes immediately
+    websocket_handler.io_loop.add_callback.side_effect = lambda callback, *args: callback(*args)
+    emitter = WebsocketCopilotResponseEmitter('chat', 'message', websocket_handler, ChatHistory())
+    return emitter, websocket_handler
+
+
+def _sent_messages(websocket_handler):
+    return [json.loads(call.args[0]) for call in websocket_handler.write_message.call_args_list if call.kwargs == {"binary": True}]
+
+
+def _sent_data(websocket_handler):
+    return [message['data'] for message in _sent_messages(websocket_handler)]
+
+
+class TestResponseEmitterStreamBatch:
+    def test_merges_text_deltas(self):
+        emitter, websocket_handler = _emitter()
+
+        emitter.stream_batch([
+            {"choices": [{"delta": {"content": "Hello", "role": "assistant"}}]},
+            {"choices": [{"delta": {"content": " world"}}]},
+        ])
+
+        assert _sent_data(websocket_handler) == [{"choices": [{"delta": {"content": "Hello world", "role": "assistant"}}]}]
+        assert emitter.streamed_contents == ["Hello world"]
+
+    def test_keeps_order_around_other_items(self):
+        emitter, websocket_handler = _emitter()
+        tool_call = {"choices": [{"delta": {"tool_calls": [{"index": 0}]}}]}
+
+        emitter.stream_batch([
+            {"choices": [{"delta": {"content": "a"}}]},
+            tool_call,
+            MarkdownData("b"),
+            {"choices": [{"delta": {"content": "c"}}]},
+        ])
+
+        messages = _sent_messages(websocket_handler)
+        assert len(messages) == 1
+        assert messages[0]["id"] == "message"
+        assert messages[0]["type"] == BackendMessageType.StreamMessage
+        sent = [message["data"] for message in messages[0]["batch"]]
+        assert len(sent) == 4
+        assert sent[2]["choices"][0]["delta"]["nbiContent"] == {"type": "markdown", "content": "b", "detail": None}
+        assert sent[0]["choices"][0]["delta"]["content"] == "a"
+        assert sent[1] == tool_call
+        assert sent[2]["choices"][0]["delta"]["nbiContent"]["content"] == "b"
+        assert sent[3]["choices"][0]["delta"]["content"] == "c"
+
+    def test_finish_after_batch(self):
+        emitter, websocket_handler = _emitter()
+
+        emitter.stream_batch([{"choices": [{"delta": {"content": "a"}}]}, MarkdownData("b")])
+        emitter.finish()
+
+        messages = _sent_messages(websocket_handler)
+        assert [message["type"] for message in messages] == [BackendMessageType.StreamMessage, BackendMessageType.StreamEnd]
+        assert all(item["id"] == "message" for item in messages[0]["batch"])
+
+    def test_drops_messages_after_close(self):
+        from tornado.websocket import WebSocketClosedError
+
+        emitter, websocket_handler = _emitter()
+        websocket_handler.write_message.side_effect = WebSocketClosedError()
+
+        emitter.stream({"choices": [{"delta": {"content": "a"}}]})
+        emitter.finish()
+
+    def test_stream_builds_nbi_content(self):
+        from notebook_intelligence.api import ButtonData
+
+        emitter, websocket_handler = _emitter()
+
+        emitter.stream(ButtonData("Configure", "open-configuration"))
+
+        assert _sent_data(websocket_handler) == [{"choices": [{"delta": {
+            "nbiContent": {"type": "button", "content": {"title": "Configure", "commandId": "open-configuration", "args": {}}},
+            "content": "",
+            "role": "assistant"
+        }}]}]
+
+    def test_stream_message_envelope(self):
+        emitter, websocket_handler = _emitter()
+        data = {"choices": [{"delta": {"content": "a"}}]}
+
+        emitter.stream(data)
+        emitter.participant_id = "mcp"
+        emitter.stream(data)
+
+        messages = _sent_messages(websocket_handler)
+        assert [message["participant"] for message in messages] == ["", "mcp"]
+        for message in messages:
+            assert message.keys() == {"id", "participant", "type", "data", "created"}
+            assert message["id"] == "message"
+            assert message["type"] == BackendMessageType.StreamMessage
+            assert message["data"] == data
+
+    def test_complete_sends_single_stream_end(self):
+        emitter, websocket_handler = _emitter()
+
+        emitter.complete({"completions": "x = 1"})
+
+        messages = _sent_messages(websocket_handler)
+        assert len(messages) == 1
+        assert messages[0]["type"] == BackendMessageType.StreamEnd
+        assert messages[0]["data"] == {"completions": "x = 1"}
+
+
+class TestTokenBudget:
+    def test_short_text_skips_encoding(self, monkeypatch):
+        from notebook_intelligence import extension
+
+        encoding = MagicMock()
+        monkeypatch.setattr(extension, '_tiktoken_encoding', encoding)
+
+        assert extension._truncate_to_token_budget("x" * 20, 80) == "x" * 20
+        encoding.encode_ordinary.assert_not_called()
+
+    def test_counts_are_cached(self, monkeypatch):
+        from notebook_intelligence import extension
+
+        encoding = MagicMock()
+        encoding.encode_ordinary.return_value = [0] * 30
+        monkeypatch.setattr(extension, '_tiktoken_encoding', encoding)
+        monkeypatch.setattr(extension, '_token_count_cache', {})
+        text = "some long context " * 10
+
+        assert extension._truncate_to_token_budget(text, 80) == text
+        assert extension._truncate_to_token_budget(text, 80) == text
+        encoding.encode_ordinary.assert_called_once_with(text)
+
+    def test_cache_is_bounded(self, monkeypatch):
+        from notebook_intelligence import extension
+
+        monkeypatch.setattr(extension, '_token_count_cache', {})
+        monkeypatch.setattr(extension, 'TOKEN_COUNT_CACHE_MAX_SIZE', 2)
+        for text in ["a" * 100, "b" * 100, "c" * 100]:
+            extension._truncate_to_token_budget(text, 80)
+
+        assert len(extension._token_count_cache) == 2
+
+    def test_truncates_by_tokens(self, monkeypatch):
+        from notebook_intelligence import extension
+
+        monkeypatch.setattr(extension, '_token_count_cache', {})
+        text = "def f(x):\n    return x * 2\n" * 50
+
+        truncated = extension._truncate_to_token_budget(text, 40)
+
+        assert truncated.endswith("...")
+        assert len(extension.get_tiktoken_encoding().encode_ordinary(truncated[:-3])) == 40
+        assert text.startswith(truncated[:-3])
+
+    def test_encoding_is_loaded_once(self):
+        from notebook_intelligence import extension
+
+        assert extension.get_tiktoken_encoding() is extension.get_tiktoken_encoding()
+
+    def test_special_tokens_are_ordinary_text(self):
+        from notebook_intelligence import extension
+
+        text = "<|endoftext|>" * 20
+        assert extension._truncate_to_token_budget(text, 1000) == text
+
+
+class TestWebsocketHandlerRequests:
+    def test_chat_request_runs_on_io_loop(self, monkeypatch):
+        import json
+        from notebook_intelligence import extension
+        from notebook_intelligence.api import RequestDataType
+
+        manager = MagicMock()
+        manager.chat_model = None
+        monkeypatch.setattr(extension, 'ai_service_manager', manager)
+        handler = extension.WebsocketCopilotHandler.__new__(extension.WebsocketCopilotHandler)
+        handler._messageCallbackHandlers = {}
+        handler.chat_history = ChatHistory()
+        handler.io_loop = MagicMock()
+
+        handler.on_message(json.dumps({
+            "id": "message",
+            "type": RequestDataType.ChatRequest,
+            "data": {"chatId": "chat", "prompt": "hi", "language": "python", "filename": "test.py", "additionalContext": [
+                {"filePath": "test.py", "startLine": 1, "endLine": 1, "currentCellContents": None, "content": "x = 1"}
+            ]}
+        }))
+
+        callback, request, response_emitter = handler.io_loop.spawn_callback.call_args.args
+        assert callback is manager.handle_chat_request
+        assert request.prompt == "hi"
+        assert [message["content"] for message in request.chat_history][1:] == ["hi"]
+        assert request.chat_history[0]["content"].startswith("Use this as additional context: ```x = 1```")
+        assert response_emitter is handler._messageCallbackHandlers["message"].response_emitter
+
+    def test_context_path_is_relative_to_root_dir(self, monkeypatch):
+        import json
+        from notebook_intelligence import extension
+        from notebook_intelligence.api import RequestDataType
+
+        manager = MagicMock()
+        manager.chat_model = None
+        monkeypatch.setattr(extension, 'ai_service_manager', manager)
+        monkeypatch.setattr(extension.NotebookIntelligence, 'root_dir', '/home/user')
+        handler = extension.WebsocketCopilotHandler.__new__(extension.WebsocketCopilotHandler)
+        handler._messageCallbackHandlers = {}
+        handler.chat_history = ChatHistory()
+        handler.io_loop = MagicMock()
+
+        handler.on_message(json.dumps({
+            "id": "message",
+            "type": RequestDataType.ChatRequest,
+            "data": {"chatId": "chat", "prompt": "hi", "language": "python", "filename": "test.py", "additionalContext": [
+                {"filePath": "/etc/passwd", "startLine": 1, "endLine": 1, "currentCellContents": None, "content": "x"}
+            ]}
+        }))
+
+        request = handler.io_loop.spawn_callback.call_args.args[1]
+        assert "at path '/home/user/etc/passwd'" in request.chat_history[0]["content"]
+
+    def test_context_path_outside_root_dir_is_ignored(self, monkeypatch):
+        import json
+        from notebook_intelligence import extension
+        from notebook_intelligence.api import RequestDataType
+
+        manager = MagicMock()
+        manager.chat_model = None
+        monkeypatch.setattr(extension, 'ai_service_manager', manager)
+        monkeypatch.setattr(extension.NotebookIntelligence, 'root_dir', '/home/user')
+        handler = extension.WebsocketCopilotHandler.__new__(extension.WebsocketCopilotHandler)
+        handler._messageCallbackHandlers = {}
+        handler.chat_history = ChatHistory()
+        handler.io_loop = MagicMock()
+
+        handler.on_message(json.dumps({
+            "id": "message",
+            "type": RequestDataType.ChatRequest,
+            "data": {"chatId": "chat", "prompt": "hi", "language": "python", "filename": "test.py", "additionalContext": [
+                {"filePath": "../../etc/passwd", "startLine": 1, "endLine": 1, "currentCellContents": None, "content": "x"},
+                {"filePath": "notebooks/../../user2/secret.py", "startLine": 1, "endLine": 1, "currentCellContents": None, "content": "y"},
+                {"filePath": "notebooks/../test.py", "startLine": 1, "endLine": 1, "currentCellContents": None, "content": "z"},
+            ]}
+        }))
+
+        request = handler.io_loop.spawn_callback.call_args.args[1]
+        assert [message["content"] for message in request.chat_history][1:] == ["hi"]
+        assert "at path '/home/user/test.py'" in request.chat_history[0]["content"]
+
+    def test_cancel_and_unknown_messages(self):
+        import json
+        from notebook_intelligence import extension
+        from notebook_intelligence.api import CancelTokenImpl, RequestDataType
+
+        handler = extension.WebsocketCopilotHandler.__new__(extension.WebsocketCopilotHandler)
+        cancel_token = CancelTokenImpl()
+        handler._messageCallbackHandlers = {"message": extension.MessageCallbackHandlers(MagicMock(), cancel_token)}
+
+        handler.on_message(json.dumps({"id": "message", "type": "unknown-request"}))
+        assert not cancel_token.is_cancel_requested
+
+        handler.on_message(json.dumps({"id": "message", "type": RequestDataType.CancelInlineCompletionRequest}))
+        assert cancel_token.is_cancel_requested
+
+
+    def test_close_cancels_requests(self):
+        from notebook_intelligence import extension
+        from notebook_intelligence.api import CancelTokenImpl
+
+        handler = extension.WebsocketCopilotHandler.__new__(extension.WebsocketCopilotHandler)
+        handler.is_closed = False
+        handler.io_loop = MagicMock()
+        emitter = WebsocketCopilotResponseEmitter('chat', 'message', handler, ChatHistory())
+        cancel_token = CancelTokenImpl()
+        handler._messageCallbackHandlers = {"message": extension.MessageCallbackHandlers(emitter, cancel_token)}
+
+        handler.on_close()
+        emitter.stream({"choices": [{"delta": {"content": "a"}}]})
+        emitter.finish()
+
+        assert cancel_token.is_cancel_requested
+        assert handler._messageCallbackHandlers == {}
+        handler.io_loop.add_callback.assert_not_called()
+
+
+class TestChatHistory:
+    def test_keeps_last_messages(self):
+        chat_history = ChatHistory()
+        for i in range(ChatHistory.MAX_MESSAGES + 5):
+            chat_history.add_message('chat', {"role": "user", "content": f"message {i}"})
+
+        history = chat_history.get_history('chat')
+        assert type(history) is list
+        assert len(history) == ChatHistory.MAX_MESSAGES
+        assert history[-1]["content"] == f"message {ChatHistory.MAX_MESSAGES + 4}"
+
+    def test_clears_when_participant_changes(self):
+        chat_history = ChatHistory()
+        chat_history.add_message('chat', {"role": "user", "content": "hello"})
+        chat_history.add_message('chat', {"role": "assistant", "content": "hi"})
+        chat_history.add_message('chat', {"role": "user", "content": "@mcp list tools"})
+
+        assert chat_history.get_history('chat') == [{"role": "user", "content": "@mcp list tools"}]
+
+    def test_clear_resets_participant(self):
+        chat_history = ChatHistory()
+        chat_history.add_message('chat', {"role": "user", "content": "@mcp list tools"})
+        chat_history.clear('chat')
+        chat_history.add_message('chat', {"role": "assistant", "content": "hi"})
+        chat_history.add_message('chat', {"role": "user", "content": "hello"})
+
+        assert len(chat_history.get_history('chat')) == 2
+
+    def test_history_is_a_snapshot(self):
+        chat_history = ChatHistory()
+        chat_history.add_message('chat', {"role": "user", "content": "hello"})
+        history = chat_history.get_history('chat')
+        history.append({"role": "user", "content": "extra"})
+
+        assert len(chat_history.get_history('chat')) == 1
+
+    def test_add_messages_checks_participant_once(self, monkeypatch):
+        from notebook_intelligence import extension
+
+        chat_history = ChatHistory()
+        chat_history.add_message('chat', {"role": "user", "content": "hello"})
+        parse_prompt = MagicMock(wraps=extension.AIServiceManager.parse_prompt)
+        monkeypatch.setattr(extension.AIServiceManager, 'parse_prompt', parse_prompt)
+
+        chat_history.add_messages('chat', [
+            {"role": "user", "content": "This file was provided as additional context"},
+            {"role": "user", "content": "@mcp list tools"},
+        ])
+
+        parse_prompt.assert_called_once_with("@mcp list tools")
+        assert [message["content"] for message in chat_history.get_history('chat')] == ["This file was provided as additional context", "@mcp list tools"]
+
+    def test_null_chat_history_keeps_nothing(self):
+        from notebook_intelligence.extension import _NULL_CHAT_HISTORY
+
+        _NULL_CHAT_HISTORY.add_message('chat', {"role": "assistant", "content": "x = 1"})
+
+        assert _NULL_CHAT_HISTORY.get_history('chat') == []
+        assert _NULL_CHAT_HISTORY.messages == {}
+
+    def test_history_view(self):
+        chat_history = ChatHistory()
+        chat_history.add_message('chat', {"role": "user", "content": "hello"})
+        view = chat_history.get_history_view('chat')
+        chat_history.add_message('chat', {"role": "assistant", "content": "hi"})
+
+        assert view == ({"role": "user", "content": "hello"},)
+        assert chat_history.get_history_view('other') == ()
+
+
+class TestGetCapabilitiesHandler:
+    def test_model_id_lists_are_cached_across_polls(self, monkeypatch):
+        from types import SimpleNamespace
+        from notebook_intelligence import ai_service_manager as ai_service_manager_module, extension
+        from notebook_intelligence.ai_service_manager import AIServiceManager
+
+        model = SimpleNamespace(id="model", name="Model", context_window=8192, properties=[])
+        provider = SimpleNamespace(
+            id="fake", name="Fake", chat_models=[model], inline_completion_models=[model], embedding_models=[],
+            get_chat_model=lambda model_id: model, get_inline_completion_model=lambda model_id: model
+        )
+        manager = AIServiceManager.__new__(AIServiceManager)
+        manager.llm_providers = {"fake": provider}
+        manager.chat_participants = {}
+        manager._model_id_cache = {}
+        manager._chat_participant_capabilities = None
+        manager._extension_toolsets = {}
+        manager._extensions = []
+        manager._mcp_manager = MagicMock()
+        manager._mcp_manager.get_mcp_servers.return_value = []
+        manager._nbi_config = SimpleNamespace(
+            nbi_user_dir="", using_github_copilot_service=False, store_github_access_token=False,
+            chat_model={"provider": "fake", "model": "model"}, inline_completion_model={}, embedding_model={},
+            mcp_server_settings={}, default_chat_mode="ask"
+        )
+        monkeypatch.setattr(ai_service_manager_module.github_copilot, "enable_github_login_status_change_updater", lambda enabled: None)
+        monkeypatch.setattr(extension, "ai_service_manager", manager, raising=False)
+        # keep the response object so that list identity can be checked
+        monkeypatch.setattr(extension, "json", SimpleNamespace(dumps=lambda data: data))
+        responses = []
+        handler = extension.GetCapabilitiesHandler.__new__(extension.GetCapabilitiesHandler)
+        handler.finish = responses.append
+
+        extension.GetCapabilitiesHandler.get.__wrapped__(handler)
+        extension.GetCapabilitiesHandler.get.__wrapped__(handler)
+
+        first, second = responses
+        assert first["chat_models"] == [{"provider": "fake", "id": "model", "name": "Model", "context_window": 8192, "properties": []}]
+        assert second["chat_models"] is first["chat_models"]
+        assert second["inline_completion_models"] is first["inline_completion_models"]
+        assert second["embedding_models"] is first["embedding_models"]
@@ -0,0 +1,228 @@
+import asyncio
+import pytest
+from unittest.mock import MagicMock
+
+from notebook_intelligence import github_copilot
+from notebook_intelligence.github_copilot import _iter_sse_data
+
+
+def _mock_response(chunks):
+    async def iter_chunks():
+        for chunk in chunks:
+            yield chunk, True
+
+    resp = MagicMock()
+    resp.content.iter_chunks = iter_chunks
+    return resp
+
+
+def _collect(chunks):
+    async def collect():
+        return [bytes(payload) async for payload in _iter_sse_data(_mock_response(chunks))]
+
+    return asyncio.run(collect())
+
+
+class TestIterSSEData:
+    def test_single_chunk(self):
+        payloads = _collect([b'data: {"a": 1}\n\ndata: [DONE]\n\n'])
+
+        assert payloads == [b'{"a": 1}', b'[DONE]']
+
+    def test_event_split_across_chunks(self):
+        payloads = _collect([b'data: {"a"', b': 1}\n', b'\ndata: {"b": 2}\n\n'])
+
+        assert payloads == [b'{"a": 1}', b'{"b": 2}']
+
+    def test_skips_non_data_events(self):
+        payloads = _collect([b': keep-alive\n\ndata: {"a": 1}\n\n'])
+
+        assert payloads == [b'{"a": 1}']
+
+    def test_unterminated_last_event(self):
+        payloads = _collect([b'data: {"a": 1}\n\ndata: [DONE]'])
+
+        assert payloads == [b'{"a": 1}', b'[DONE]']
+
+    def test_crlf_line_endings(self):
+        payloads = _collect([b'data: {"a": 1}\r\n\r\ndata:{"b": 2}\r', b'\n\r\n'])
+
+        assert payloads == [b'{"a": 1}', b'{"b": 2}']
+
+
+class TestPromptCache:
+    def setup_method(self):
+        github_copilot.clear_cache()
+
+    def test_hit_returns_copy(self):
+        key = github_copilot._prompt_cache_key('', {'messages': [{'role': 'user', 'content': 'hi'}]})
+        github_copilot._cache_response(key, {'choices': [{'message': {'role': 'assistant'}}]})
+
+        cached = github_copilot._get_cached_response(key)
+        cached['choices'].append({})
+
+        assert github_copilot._get_cached_response(key) == {'choices': [{'message': {'role': 'assistant'}}]}
+
+    def test_namespace_isolates_keys(self):
+        data = {'messages': [{'role': 'user', 'content': 'hi'}]}
+
+        assert github_copilot._prompt_cache_key('a', data) != github_copilot._prompt_cache_key('b', data)
+
+    def test_expired_entry_is_dropped(self, monkeypatch):
+        monkeypatch.setattr(github_copilot, 'PROMPT_CACHE_TTL', -1)
+        github_copilot._cache_response('key', {'choices': []})
+
+        assert github_copilot._get_cached_response('key') is None
+        assert 'key' not in github_copilot._prompt_cache
+
+    def test_evicts_least_recently_used(self, monkeypatch):
+        monkeypatch.setattr(github_copilot, 'PROMPT_CACHE_MAX_SIZE', 2)
+        github_copilot._cache_response('a', {})
+        github_copilot._cache_response('b', {})
+        github_copilot._get_cached_response('a')
+        github_copilot._cache_response('c', {})
+
+        assert list(github_copilot._prompt_cache) == ['a', 'c']
+
+
+class TestGetToken:
+    def test_concurrent_calls_share_one_refresh(self, monkeypatch):
+        import threading
+
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def refresh():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+
+        monkeypatch.setattr(github_copilot, '_refresh_token', refresh)
+        monkeypatch.setattr(github_copilot, 'TOKEN_REFRESH_WAIT_TIMEOUT', 0.01)
+        first = threading.Thread(target=github_copilot.get_token)
+        first.start()
+        started.wait(5)
+        # refresh in flight, second caller waits instead of refreshing
+        github_copilot.get_token()
+        release.set()
+        first.join(5)
+
+        assert calls == [1]
+        assert not github_copilot._token_refresh_inflight
+
+
+class TestCopilotHeaders:
+    def test_request_ids_are_unique_uuid4(self):
+        import uuid
+
+        headers = github_copilot.generate_copilot_headers()
+        ids = [github_copilot._next_uuid() for _ in range(github_copilot.UUID_POOL_SIZE * 2)]
+
+        assert headers['x-request-id'] != headers['vscode-sessionid']
+        assert len(set(ids)) == len(ids)
+        assert all(uuid.UUID(id).version == 4 for id in ids)
+
+    def test_static_headers_not_mutated(self):
+        github_copilot.generate_copilot_headers()
+
+        assert 'authorization' not in github_copilot._COPILOT_STATIC_HEADERS
+
+
+class TestTokenLifecycle:
+    def test_polls_then_refreshes_then_exits_on_logout(self, monkeypatch):
+        import time
+
+        auth = {**github_copilot.github_auth, "status": github_copilot.LoginStatus.ACTIVATING_DEVICE, "device_code": "code", "access_token": None, "token": None, "interval": 0}
+        monkeypatch.setattr(github_copilot, 'github_auth', auth)
+        monkeypatch.setattr(github_copilot, 'TOKEN_THREAD_SLEEP_INTERVAL', 0.01)
+        monkeypatch.setattr(github_copilot, 'TOKEN_FETCH_INTERVAL', -1)
+        calls = []
+
+        def poll():
+            calls.append('poll')
+            if calls.count('poll') == 2:
+                auth["access_token"] = "access"
+
+        def get_token():
+            calls.append('refresh')
+            auth["status"] = github_copilot.LoginStatus.NOT_LOGGED_IN
+
+        monkeypatch.setattr(github_copilot, '_poll_user_access_token', poll)
+        monkeypatch.setattr(github_copilot, 'get_token', get_token)
+
+        github_copilot.wait_for_tokens()
+        github_copilot.wait_for_tokens()
+        deadline = time.monotonic() + 5
+        while github_copilot._token_lifecycle_future is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        assert calls == ['poll', 'poll', 'refresh']
+        assert github_copilot._token_lifecycle_future is None
+
+
+class TestIterBatches:
+    def _collect_batches(self, delays, max_size=16, interval=0.05):
+        async def items():
+            for index, delay in enumerate(delays):
+                await asyncio.sleep(delay)
+                yield index
+
+        async def collect():
+            return [batch async for batch in github_copilot._iter_batches(items(), max_size, interval)]
+
+        return asyncio.run(collect())
+
+    def test_flushes_on_deadline_during_pause(self):
+        # second item arrives long after the interval, first must not wait for it
+        assert self._collect_batches([0, 0, 0.3]) == [[0, 1], [2]]
+
+    def test_flushes_on_max_size(self):
+        assert self._collect_batches([0] * 5, max_size=2) == [[0, 1], [2, 3], [4]]
+
+    def test_empty(self):
+        assert self._collect_batches([]) == []
+
+
+class TestCompletionsStreaming:
+    def test_streams_batches_and_finishes(self, monkeypatch):
+        from notebook_intelligence.api import ChatResponse
+
+        class _Response(ChatResponse):
+            def __init__(self):
+                super().__init__()
+                self.batches = []
+                self.finished = 0
+
+            def stream_batch(self, data):
+                self.batches.append(data)
+
+            def finish(self):
+                self.finished += 1
+
+        class _Request:
+            status = 200
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *args):
+                return False
+
+        async def sse_data(request):
+            yield b'{"choices": [{"delta": {"content": "a"}}]}'
+            yield b'{"choices": [{"delta": {"content": "b"}}]}'
+            await asyncio.sleep(0.2)
+            yield b'{"choices": [{"delta": {"content": "c"}}]}'
+            yield b'[DONE]'
+
+        session = MagicMock()
+        session.post.return_value = _Request()
+        monkeypatch.setattr(github_copilot, '_get_http_session', lambda: session)
+        monkeypatch.setattr(github_copilot, '_iter_sse_data', sse_data)
+        response = _Response()
+
+        asyncio.run(github_copilot._completions('gpt-4o', [], response=response))
+
+        assert [[chunk['choices'][0]['delta']['content'] for chunk in batch] for batch in response.batches] == [['a', 'b'], ['c']]
+        assert response.finished == 1
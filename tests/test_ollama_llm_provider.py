@@ -0,0 +1,205 @@
+from unittest.mock import MagicMock
+
+import pytest
+from ollama import ChatResponse, Message
+
+from notebook_intelligence.llm_providers import ollama_llm_provider
+from notebook_intelligence.llm_providers.ollama_llm_provider import OllamaChatModel
+
+
+class TestFIMPromptTemplate:
+    @pytest.mark.parametrize("template, format_string", [
+        (ollama_llm_provider.QWEN_INLINE_COMPL_PROMPT, "<|fim_prefix|>{prefix}<|fim_suffix|>{suffix}<|fim_middle|>"),
+        (ollama_llm_provider.DEEPSEEK_INLINE_COMPL_PROMPT, "<｜fim▁begin｜>{prefix}<｜fim▁hole｜>{suffix}<｜fim▁end｜>"),
+        (ollama_llm_provider.CODELLAMA_INLINE_COMPL_PROMPT, "<PRE> {prefix} <SUF>{suffix} <MID>"),
+        (ollama_llm_provider.STARCODER_INLINE_COMPL_PROMPT, "<fim_prefix>{prefix}<fim_suffix>{suffix}<fim_middle>"),
+        (ollama_llm_provider.CODESTRAL_INLINE_COMPL_PROMPT, "[SUFFIX]{suffix}[PREFIX]{prefix}"),
+    ])
+    def test_matches_format_string(self, template, format_string):
+        prefix, suffix = "def f():\n    return {", "}\n"
+
+        assert template.format(prefix=prefix, suffix=suffix) == format_string.format(prefix=prefix, suffix=suffix)
+
+
+class TestOllamaInlineCompletionModel:
+    def test_generate_args_prompt(self):
+        model = ollama_llm_provider.OllamaInlineCompletionModel(None, "qwen2.5-coder", "qwen2.5-coder", 32768, ollama_llm_provider.QWEN_INLINE_COMPL_PROMPT)
+
+        assert model._generate_args("x = ", "  \n")["prompt"] == "x = "
+        assert model._generate_args("x = ", "\nprint(x)\n")["prompt"] == "<|fim_prefix|>x = <|fim_suffix|>print(x)<|fim_middle|>"
+
+
+class TestOllamaChatModel:
+    def test_completions_returns_message_dict(self):
+        message = Message(role='assistant', content='hi', tool_calls=[
+            Message.ToolCall(function=Message.ToolCall.Function(name='get_cell_output', arguments={'cell_index': 1}))
+        ])
+        provider = MagicMock()
+        provider.client.chat = lambda **kwargs: ChatResponse(model='llama3', message=message)
+        model = OllamaChatModel(provider, 'llama3', 'llama3', 8192)
+
+        response = model.completions([{"role": "user", "content": "hello"}])
+
+        response_message = response['choices'][0]['message']
+        assert response_message['content'] == 'hi'
+        assert response_message['tool_calls'] == [{'function': {'name': 'get_cell_output', 'arguments': {'cell_index': 1}}}]
+
+    def test_acompletions_streams_with_async_client(self):
+        import asyncio
+        from notebook_intelligence.api import CancelTokenImpl
+
+        async def chunks():
+            for content in ["a", "b", "c"]:
+                yield {"message": {"role": "assistant", "content": content}}
+                if content == "b":
+                    cancel_token.cancel_request()
+
+        async def chat(**kwargs):
+            assert kwargs["stream"] is True
+            return chunks()
+
+        provider = MagicMock()
+        provider.get_async_client.return_value.chat = chat
+        model = OllamaChatModel(provider, 'llama3', 'llama3', 8192)
+        streamed_contents = []
+        response = MagicMock()
+        response.stream.side_effect = lambda data: streamed_contents.append(data["choices"][0]["delta"]["content"])
+        cancel_token = CancelTokenImpl()
+
+        asyncio.run(model.acompletions([{"role": "user", "content": "hello"}], response=response, cancel_token=cancel_token))
+
+        assert streamed_contents == ["a", "b"]
+        response.finish.assert_called_once()
+
+    def test_completions_streams_chunks(self):
+        chunks = [{"message": {"role": "assistant", "content": content}} for content in ["a", "b"]]
+        provider = MagicMock()
+        provider.client.chat = lambda **kwargs: iter(chunks)
+        model = OllamaChatModel(provider, 'llama3', 'llama3', 8192)
+        streamed = []
+        response = MagicMock()
+        response.stream.side_effect = lambda data: streamed.append((data["choices"][0]["delta"]["role"], data["choices"][0]["delta"]["content"]))
+
+        model.completions([{"role": "user", "content": "hello"}], response=response)
+
+        assert streamed == [("assistant", "a"), ("assistant", "b")]
+        response.finish.assert_called_once()
+
+
+class TestOllamaLLMProvider:
+    def test_model_info_is_cached_by_digest(self, monkeypatch):
+        from ollama import ListResponse, ShowResponse
+
+        def _model(name, digest):
+            return ListResponse.Model(model=name, digest=digest, details={"family": "llama"})
+
+        models = [_model('llama3', 'a'), _model('llama3.1', 'b')]
+        monkeypatch.setattr(ollama_llm_provider, '_context_window_cache', {})
+        client = MagicMock()
+        client.list = lambda: ListResponse(models=models)
+        client.show.return_value = ShowResponse(model_info={"llama.context_length": 8192})
+        show = client.show
+        monkeypatch.setattr(ollama_llm_provider.ollama, 'Client', lambda: client)
+
+        provider = ollama_llm_provider.OllamaLLMProvider()
+        provider._initial_update_thread.join(5)
+        assert show.call_count == 2
+
+        models.append(_model('llama3', 'c'))
+        provider.update_chat_model_list()
+        assert show.call_count == 3
+        assert [model.context_window for model in provider.chat_models] == [8192, 8192, 8192]
+
+    def test_model_info_is_fetched_concurrently_in_order(self, monkeypatch):
+        import threading
+        from ollama import ListResponse, ShowResponse
+
+        models = [
+            ListResponse.Model(model='llama3', digest='a', details={"family": "llama"}),
+            ListResponse.Model(model='nomic-embed-text', digest='b', details={"family": "nomic-bert"}),
+            ListResponse.Model(model='qwen2', digest='c', details={"family": "qwen2"}),
+        ]
+        barrier = threading.Barrier(2, timeout=5)
+
+        def show(name):
+            # both lookups must be in flight at once to get past the barrier
+            barrier.wait()
+            family = "llama" if name == "llama3" else "qwen2"
+            return ShowResponse(model_info={f"{family}.context_length": len(name)})
+
+        client = MagicMock()
+        client.list = lambda: ListResponse(models=models)
+        client.show = show
+        monkeypatch.setattr(ollama_llm_provider, '_context_window_cache', {})
+        monkeypatch.setattr(ollama_llm_provider.ollama, 'Client', lambda: client)
+
+        provider = ollama_llm_provider.OllamaLLMProvider()
+        provider._initial_update_thread.join(5)
+
+        assert [(model.id, model.context_window) for model in provider.chat_models] == [('llama3', 6), ('qwen2', 5)]
+
+    def test_model_without_context_length_is_skipped(self, monkeypatch):
+        from ollama import ListResponse, ShowResponse
+
+        client = MagicMock()
+        client.list = lambda: ListResponse(models=[
+            ListResponse.Model(model='llama3', digest='a', details={"family": "llama"}),
+            ListResponse.Model(model='custom', digest='b', details={"family": "custom"}),
+        ])
+        client.show.return_value = ShowResponse(model_info={"llama.context_length": 8192})
+        monkeypatch.setattr(ollama_llm_provider, '_context_window_cache', {})
+        monkeypatch.setattr(ollama_llm_provider.ollama, 'Client', lambda: client)
+
+        provider = ollama_llm_provider.OllamaLLMProvider()
+        provider._initial_update_thread.join(5)
+
+        assert [model.id for model in provider.chat_models] == ['llama3']
+
+    def test_initial_model_list_does_not_block(self, monkeypatch):
+        import threading
+        from ollama import ListResponse, ShowResponse
+
+        listing = threading.Event()
+        client = MagicMock()
+        client.list = lambda: listing.wait(5) and ListResponse(models=[
+            ListResponse.Model(model='llama3', digest='a', details={"family": "llama"}),
+        ])
+        client.show.return_value = ShowResponse(model_info={"llama.context_length": 8192})
+        monkeypatch.setattr(ollama_llm_provider, '_context_window_cache', {})
+        monkeypatch.setattr(ollama_llm_provider.ollama, 'Client', lambda: client)
+
+        provider = ollama_llm_provider.OllamaLLMProvider()
+        updates = []
+        provider.chat_models_updated_signal.connect(lambda: updates.append(True))
+
+        # an unresponsive Ollama does not block chat_models
+        assert provider.chat_models == []
+
+        listing.set()
+        provider._initial_update_thread.join(5)
+        assert [model.id for model in provider.chat_models] == ['llama3']
+        assert updates == [True]
+
+    def test_async_client_per_event_loop(self, monkeypatch):
+        import asyncio
+
+        monkeypatch.setattr(ollama_llm_provider.OllamaLLMProvider, 'update_chat_model_list', lambda self: None)
+        provider = ollama_llm_provider.OllamaLLMProvider()
+
+        async def get_clients():
+            return provider.get_async_client(), provider.get_async_client()
+
+        first, second = asyncio.run(get_clients())
+        assert first is second
+        assert asyncio.run(get_clients())[0] is not first
+
+    def test_sync_calls_share_one_client(self, monkeypatch):
+        monkeypatch.setattr(ollama_llm_provider.OllamaLLMProvider, 'update_chat_model_list', lambda self: None)
+        provider = ollama_llm_provider.OllamaLLMProvider()
+        generate = MagicMock(return_value=MagicMock(response="x = 1"))
+        provider.client.generate = generate
+
+        for model in provider.inline_completion_models[:2]:
+            assert model.inline_completions("x = ", "", "python", "a.py", None, None) == "x = 1"
+
+        assert generate.call_count == 2
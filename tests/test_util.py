@@ -0,0 +1,58 @@
+import pytest
+
+from notebook_intelligence import util
+
+JSON_IMPLEMENTATIONS = [(util._stdlib_json_loads, util._stdlib_json_dumps)]
+if util.orjson is not None:
+    JSON_IMPLEMENTATIONS.append((util._orjson_loads, util._orjson_dumps))
+
+
+@pytest.mark.parametrize("json_loads,json_dumps", JSON_IMPLEMENTATIONS)
+class TestJson:
+    def test_round_trip(self, json_loads, json_dumps):
+        data = {"b": [1, 2.5, None, True], "a": {"text": "héllo"}}
+
+        assert json_loads(json_dumps(data)) == data
+        assert json_loads(json_dumps(data).encode('utf-8')) == data
+        assert json_loads(bytearray(json_dumps(data).encode('utf-8'))) == data
+
+    def test_sort_keys_compact(self, json_loads, json_dumps):
+        assert json_dumps({"b": 1, "a": [1, 2]}, sort_keys=True) == '{"a":[1,2],"b":1}'
+
+    def test_non_str_keys_are_coerced(self, json_loads, json_dumps):
+        assert json_loads(json_dumps({1: "a"})) == {"1": "a"}
+
+    def test_default(self, json_loads, json_dumps):
+        class Value:
+            def __str__(self):
+                return "value"
+
+        assert json_dumps([Value()], default=str) == '["value"]'
+
+
+JSON_BYTES_IMPLEMENTATIONS = [util._stdlib_json_dumps_bytes]
+if util.orjson is not None:
+    JSON_BYTES_IMPLEMENTATIONS.append(util._orjson_dumps_bytes)
+
+
+@pytest.mark.parametrize("json_dumps_bytes", JSON_BYTES_IMPLEMENTATIONS)
+def test_json_dumps_bytes(json_dumps_bytes):
+    data = {"a": {"text": "héllo"}, 1: [True, None]}
+
+    assert json_dumps_bytes(data) == '{"a":{"text":"héllo"},"1":[true,null]}'.encode('utf-8')
+
+
+class TestExtractLlmGeneratedCode:
+    @pytest.mark.parametrize("code,expected", [
+        ("x = 1", "x = 1"),
+        ("x = 1```", "x = 1"),
+        ("x = 1\ny = 2", "x = 1\ny = 2"),
+        ("```python\nx = 1\n```", "x = 1\n"),
+        ("Here it is:\n  ```python\nx = 1\ny = 2\n  ```\nmore text", "x = 1\ny = 2"),
+        ("```python\nx = 1\n", "x = 1\n"),
+        ("text\n```", "text\n"),
+        ("```\n```\nx = 1", ""),
+        ("```python", "```python"),
+    ])
+    def test_extract(self, code, expected):
+        assert util.extract_llm_generated_code(code) == expected